@@ -0,0 +1,240 @@
+"""OpenRouter client and JSON helpers shared by the chat, insights and visualize functions.
+
+Each deployed function still gets its own copy of the module state (the
+connection pool and the gzip flag); only the code is shared.
+"""
+from collections import OrderedDict
+import gzip
+import http.client
+import io
+import json
+import logging
+import os
+import threading
+import urllib.error
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is used instead
+    orjson = None
+
+OPENROUTER_HOST = "openrouter.ai"
+OPENROUTER_PATH = "/api/v1/chat/completions"
+POOL_MAXSIZE = 8
+# With OPENROUTER_GZIP_REQUESTS=1, request bodies at least this large are sent
+# gzip-compressed. OpenRouter does not document accepting them, so it is opt-in.
+GZIP_MIN_BYTES = 2048
+# Longest cell value shown to the model in a prompt's result table
+PROMPT_MAX_VALUE_CHARS = 128
+
+log = logging.getLogger(__name__)
+
+# Idle keep-alive connections to OpenRouter, shared across warm invocations
+_pool: list[http.client.HTTPSConnection] = []
+_pool_lock = threading.Lock()
+# Cleared if OpenRouter turns out not to accept compressed request bodies
+_gzip_request_bodies = os.environ.get("OPENROUTER_GZIP_REQUESTS") == "1"
+
+# Compact, non-ASCII-escaping encoder for payloads and responses, and its
+# escaping twin for text with lone surrogates (e.g. "\ud800" in a request
+# body), which has no UTF-8 form
+_json_encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+_json_encode_ascii = json.JSONEncoder(separators=(",", ":")).encode
+
+# orjson when it is installed, otherwise the stdlib encoders above.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch the
+# same exception.
+if orjson is not None:
+    loads = orjson.loads
+
+    def dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            return _json_encode_ascii(obj).encode("ascii")
+else:
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        try:
+            return _json_encode(obj).encode("utf-8")
+        except UnicodeEncodeError:
+            return _json_encode_ascii(obj).encode("ascii")
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping for the functions' in-process caches."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+def prompt_value(value) -> str:
+    """A result cell as shown to the model, cut to PROMPT_MAX_VALUE_CHARS."""
+    text = str(value)
+    if len(text) > PROMPT_MAX_VALUE_CHARS:
+        return text[: PROMPT_MAX_VALUE_CHARS - 1] + "…"
+    return text
+
+
+def strip_code_fence(text: str) -> str:
+    """Drop a surrounding ```lang ... ``` fence from stripped text, if present."""
+    if not text.startswith("```"):
+        return text
+    nl = text.find("\n")
+    text = text[nl + 1 :] if nl != -1 else text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+
+def _object_end(s: str, start: int) -> int | None:
+    """Return the index just past the {...} opening at s[start], or None if it never closes.
+
+    Single linear pass tracking brace depth and string-literal state, so
+    braces inside strings and escaped quotes are handled without backtracking.
+    """
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(s)):
+        ch = s[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def find_json_object(s: str) -> str | None:
+    """Return the first balanced top-level {...} substring of s, or None.
+
+    A "{" that never closes (e.g. a stray brace in prose before the object)
+    is skipped and the scan restarts from the next one.
+    """
+    start = s.find("{")
+    while start != -1:
+        end = _object_end(s, start)
+        if end is not None:
+            return s[start:end]
+        start = s.find("{", start + 1)
+    return None
+
+
+def post_openrouter(payload: bytes, headers: dict, timeout: float, consume=None, compress: bool = True):
+    """POST a payload to OpenRouter over a pooled keep-alive HTTPS connection.
+
+    Returns the response body, or consume(resp) for a successful response if
+    consume is given (used to read a stream as it arrives). A pooled
+    connection the server already closed is retried once on a fresh one,
+    before any of the response is read. Non-2xx responses raise
+    urllib.error.HTTPError, as urlopen did.
+
+    Large payloads are gzip-compressed if OPENROUTER_GZIP_REQUESTS=1. A 400
+    or 415 for a compressed request is retried uncompressed, since the
+    rejection may not say why; if that retry succeeds, compression is
+    turned off for the process.
+    Whole-body responses are requested gzip-compressed and inflated here.
+    """
+    global _gzip_request_bodies
+    original_headers = headers
+    headers = dict(headers)
+    body = payload
+    compressed = compress and _gzip_request_bodies and len(payload) >= GZIP_MIN_BYTES
+    if compressed:
+        body = gzip.compress(payload, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+    if consume is None:
+        # Streams stay uncompressed so deltas are not held back by inflating
+        headers["Accept-Encoding"] = "gzip"
+
+    for attempt in range(2):
+        with _pool_lock:
+            conn = _pool.pop() if _pool else None
+        reused = conn is not None
+        if conn is None:
+            conn = http.client.HTTPSConnection(OPENROUTER_HOST, timeout=timeout)
+        else:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+
+        try:
+            conn.request("POST", OPENROUTER_PATH, body=body, headers=headers)
+            resp = conn.getresponse()
+            break
+        except ConnectionError:
+            conn.close()
+            if reused and attempt == 0:
+                continue
+            raise
+        except Exception:
+            conn.close()
+            raise
+
+    try:
+        if consume is None or resp.status >= 400:
+            result = resp.read()
+            if resp.getheader("Content-Encoding", "").lower() == "gzip":
+                result = gzip.decompress(result)
+        else:
+            result = consume(resp)
+            # Drain the end of the stream so the connection can be reused
+            resp.read()
+    except Exception:
+        conn.close()
+        raise
+
+    if resp.will_close:
+        conn.close()
+    else:
+        with _pool_lock:
+            if len(_pool) < POOL_MAXSIZE:
+                _pool.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    if compressed and resp.status in (400, 415):
+        result = post_openrouter(payload, original_headers, timeout, consume, compress=False)
+        # Only reached when the uncompressed retry succeeded
+        _gzip_request_bodies = False
+        log.warning("OpenRouter rejected a gzip request body (%d); sending uncompressed from now on", resp.status)
+        return result
+
+    if resp.status >= 400:
+        raise urllib.error.HTTPError(
+            f"https://{OPENROUTER_HOST}{OPENROUTER_PATH}",
+            resp.status,
+            resp.reason,
+            resp.headers,
+            io.BytesIO(result),
+        )
+    return result
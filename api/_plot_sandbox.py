@@ -0,0 +1,182 @@
+"""Validation and compilation of LLM-generated plot code.
+
+Shared by the insights and visualize functions. The code is checked
+against an allowlist at the AST level, then compiled into a plain function
+whose only names are the df/pd/px/go/print arguments. encode_response
+serialises the figure dicts it returns.
+"""
+import ast
+
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+from plotly.utils import PlotlyJSONEncoder
+
+from api._openrouter import orjson
+
+
+# Encoders for response bodies holding run_plot figure dicts, and the
+# escaping one for text with lone surrogates, which has no UTF-8 form
+_response_encoder = PlotlyJSONEncoder(separators=(",", ":"), ensure_ascii=False)
+_response_encoder_ascii = PlotlyJSONEncoder(separators=(",", ":"))
+
+
+def _noop_print(*args, **kwargs) -> None:
+    pass
+
+
+# Names the plot code can use; they are passed in as arguments
+PLOT_SCOPE_ARGS = ("df", "pd", "px", "go", "print")
+# The only attributes the plot code may take from the modules in scope.
+# Anything else (pd.io, pd.compat, px.np, px.defaults, ...) reaches file
+# I/O, code evaluation or global state.
+_MODULE_ATTRS = {
+    "pd": frozenset({
+        "DataFrame", "Series", "Index", "MultiIndex", "Categorical", "CategoricalDtype",
+        "Timestamp", "Timedelta", "Period", "NA", "NaT", "Grouper", "IndexSlice",
+        "concat", "merge", "merge_asof", "melt", "pivot", "pivot_table", "crosstab",
+        "wide_to_long", "cut", "qcut", "get_dummies", "factorize", "unique",
+        "to_datetime", "to_numeric", "to_timedelta", "date_range", "period_range",
+        "timedelta_range", "isna", "isnull", "notna", "notnull",
+    }),
+    "px": frozenset({
+        "area", "bar", "bar_polar", "box", "choropleth", "density_contour",
+        "density_heatmap", "ecdf", "funnel", "funnel_area", "histogram", "icicle",
+        "imshow", "line", "line_3d", "line_polar", "parallel_categories",
+        "parallel_coordinates", "pie", "scatter", "scatter_3d", "scatter_matrix",
+        "scatter_polar", "strip", "sunburst", "timeline", "treemap", "violin", "colors",
+    }),
+    # Trace, layout and Figure classes
+    "go": frozenset(name for name in dir(go) if name[:1].isupper()),
+}
+# to_* methods that build values instead of writing to a path or buffer;
+# every other to_* (to_csv, to_json, to_html, to_string, to_clipboard, ...)
+# is rejected
+_SAFE_TO_METHODS = frozenset({
+    "to_datetime", "to_numeric", "to_timedelta", "to_period", "to_timestamp",
+    "to_pydatetime", "to_frame", "to_series", "to_list", "to_dict", "to_numpy",
+    "to_flat_index",
+})
+# Attributes on any object that evaluate code, reach frames/code objects,
+# reach numpy or pandas internals, or touch the filesystem
+_BLOCKED_ATTRS = frozenset({
+    "f_back", "f_builtins", "f_code", "f_globals", "f_locals",
+    "gi_code", "gi_frame", "cr_code", "cr_frame", "ag_code", "ag_frame",
+    "tb_frame", "tb_next",
+    "eval", "query", "compat", "np", "numpy", "ctypes",
+    "tofile", "dump", "dumps", "save", "savez", "savetxt", "savefig", "load",
+    "loadtxt", "fromfile", "memmap", "show",
+})
+_BLOCKED_CALLS = frozenset({
+    "eval", "exec", "compile", "open", "globals", "locals", "vars",
+    "getattr", "setattr", "delattr", "breakpoint", "input",
+})
+_PLOT_TEMPLATE = "def _plot({}):\n    return fig\n".format(", ".join(PLOT_SCOPE_ARGS))
+
+
+def _blocked_attr(attr: str) -> bool:
+    if attr.startswith(("_", "read_", "write_")) or attr in _BLOCKED_ATTRS:
+        return True
+    return attr.startswith("to_") and attr not in _SAFE_TO_METHODS
+
+
+def check_plot_ast(tree: ast.Module) -> None:
+    """Reject plot code that reaches outside the df/pd/px/go scope.
+
+    pd, px and go may only be used as <module>.<allowed name>, so they cannot
+    be aliased or passed around to dodge the allowlist.
+    """
+    assigns_fig = False
+    module_bases = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            raise ValueError("imports are not allowed in plot code")
+        if isinstance(node, (ast.Global, ast.Nonlocal)):
+            raise ValueError("global/nonlocal are not allowed in plot code")
+        if isinstance(node, ast.Attribute):
+            base = node.value
+            if isinstance(base, ast.Name) and base.id in _MODULE_ATTRS:
+                module_bases.add(id(base))
+                if node.attr not in _MODULE_ATTRS[base.id]:
+                    raise ValueError(f"attribute '{base.id}.{node.attr}' is not allowed in plot code")
+            elif _blocked_attr(node.attr):
+                raise ValueError(f"attribute '{node.attr}' is not allowed in plot code")
+        if isinstance(node, ast.Name):
+            if node.id.startswith("__"):
+                raise ValueError(f"name '{node.id}' is not allowed in plot code")
+            if node.id == "fig" and isinstance(node.ctx, ast.Store):
+                assigns_fig = True
+            # ast.walk yields an Attribute before its value, so a module
+            # used as an attribute base has already been recorded
+            if node.id in _MODULE_ATTRS and id(node) not in module_bases:
+                raise ValueError(f"'{node.id}' may only be used as {node.id}.<name> in plot code")
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in _BLOCKED_CALLS
+        ):
+            raise ValueError(f"call to '{node.func.id}' is not allowed in plot code")
+    if not assigns_fig:
+        raise ValueError("Code did not produce a `fig` variable")
+
+
+def compile_plot_code(python_code: str, filename: str = "<plot>"):
+    """Validate plot code and compile it into a function.
+
+    The snippet becomes the body of _plot(df, pd, px, go, print) returning
+    fig, so the scope names are fast locals rather than globals. Callers
+    cache the result per source.
+    """
+    tree = ast.parse(python_code, filename=filename, mode="exec")
+    check_plot_ast(tree)
+    module = ast.parse(_PLOT_TEMPLATE, filename=filename, mode="exec")
+    func_def = module.body[0]
+    func_def.body[:0] = tree.body
+    namespace = {"__builtins__": {}}
+    exec(compile(module, filename, "exec"), namespace)
+    return namespace["_plot"]
+
+
+def run_plot(plot, df: pd.DataFrame) -> dict:
+    """Call a compiled plot function and return the Plotly figure dict.
+
+    The dict may hold numpy values; encode it with encode_response.
+    """
+    try:
+        fig = plot(df, pd, px, go, _noop_print)
+    except UnboundLocalError as e:
+        # fig is only assigned on a branch that did not run
+        if "'fig'" not in str(e):
+            raise
+        fig = None
+    if fig is None:
+        raise ValueError("Code did not produce a `fig` variable")
+
+    if not isinstance(fig, go.Figure):
+        raise ValueError(f"fig is not a plotly Figure (got {type(fig).__name__})")
+
+    # Hand back the figure dict directly instead of a to_json()/json.loads
+    # round trip; the handlers encode the response once.
+    spec = fig.to_plotly_json()
+    for trace in spec.get("data", []):
+        trace.pop("uid", None)
+    return spec
+
+
+def encode_response(data) -> bytes:
+    """Encode a response body that may embed run_plot figure dicts."""
+    if orjson is not None:
+        # Anything orjson does not know natively goes through
+        # PlotlyJSONEncoder.default
+        try:
+            return orjson.dumps(
+                data,
+                default=_response_encoder.default,
+                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+            )
+        except orjson.JSONEncodeError:
+            return _response_encoder_ascii.encode(data).encode("ascii")
+    try:
+        return _response_encoder.encode(data).encode("utf-8")
+    except UnicodeEncodeError:
+        return _response_encoder_ascii.encode(data).encode("ascii")
@@ -1,30 +1,77 @@
 from http.server import BaseHTTPRequestHandler
+import hashlib
 import json
 import os
-import re
-import urllib.request
+import urllib.error
+
+from api._openrouter import LRUCache, dumps, find_json_object, loads, post_openrouter, strip_code_fence
 
 FALLBACK_RESPONSE = {
     "sql": "",
     "explanation": "I couldn't generate a valid response. Please try rephrasing your question.",
 }
 
+VALID_ROLES = {"user", "assistant"}
+
+# Approximate token budget for the chat history sent with each turn
+HISTORY_TOKEN_BUDGET = 4000
+
+OPENROUTER_MODEL = os.environ.get("OPENROUTER_MODEL", "openai/gpt-oss-120b:free")
+
+PROMPT_CACHE_SIZE = 128
+RESPONSE_CACHE_SIZE = 512
+PARSE_CACHE_SIZE = 1024
+
+
+# System prompts keyed by schema fingerprint
+_prompt_cache = LRUCache(PROMPT_CACHE_SIZE)
+# Encoded request body up to the chat history, keyed by (system prompt, cache key)
+_payload_prefix_cache = LRUCache(PROMPT_CACHE_SIZE)
+# Parsed LLM replies keyed by schema fingerprint + conversation
+_response_cache = LRUCache(RESPONSE_CACHE_SIZE)
+# parse_llm_response results keyed by the raw LLM content string
+_parse_cache = LRUCache(PARSE_CACHE_SIZE)
+
+
+# Static parts of the system prompt, built once at import; only the schema
+# header and rule 4 vary per table
+_SYSTEM_PROMPT_FORMAT = """
+RESPONSE FORMAT:
+Always return valid JSON (no markdown code blocks). Use one of these two formats:
+
+1. When the user asks a data question (queries, analysis, aggregations, filters, etc.):
+{"type": "sql", "sql": "SELECT ...", "explanation": "..."}
+
+2. When the user is chatting (greetings, reactions, follow-up clarifications, thanks, etc.):
+{"type": "chat", "message": "your friendly response here"}
+
+RULES:
+1. Only generate SQL when the user is clearly asking a data question
+2. For casual messages (hi, wow, thanks, ok, etc.), respond conversationally — do NOT generate SQL
+3. Use only SELECT statements (no INSERT/UPDATE/DELETE/DROP)
+"""
+_SYSTEM_PROMPT_RULES_TAIL = """5. Keep SQL concise and readable
+6. Limit results to 100 rows max unless the user asks for more
+7. Use conversation history to understand follow-up questions (e.g. "break that down by month" refers to the previous query)
+8. Do NOT wrap the JSON in markdown code blocks — return raw JSON only"""
+
 
 def build_system_prompt(schema: dict) -> str:
-    columns_desc = "\n".join(
-        f"- {col['name']} ({col['type']})" for col in schema["columns"]
-    )
+    cols = schema["columns"]
+    names = tuple(col["name"] for col in cols)
+    types = tuple(col["type"] for col in cols)
+
+    columns_desc = "\n".join(f"- {n} ({t})" for n, t in zip(names, types))
 
-    header = " | ".join(col["name"] for col in schema["columns"])
+    header = " | ".join(names)
     sample_lines = []
     for row in schema.get("sampleRows", []):
-        vals = " | ".join(
-            str(row.get(col["name"], "NULL")) for col in schema["columns"]
-        )
+        vals = " | ".join(str(row.get(n, "NULL")) for n in names)
         sample_lines.append(f"| {vals} |")
     sample_rows = "\n".join(sample_lines)
 
-    return f"""You are a friendly data analyst assistant. You can have natural conversations AND write DuckDB-compatible SQL queries.
+    return (
+        f"""You are a friendly data analyst assistant. You can have natural conversations AND write DuckDB-compatible SQL queries.
 
 You have access to this dataset:
 
@@ -36,25 +83,87 @@ COLUMNS:
 SAMPLE ROWS:
 | {header} |
 {sample_rows}
+"""
+        + _SYSTEM_PROMPT_FORMAT
+        + f"""4. Always query from "{schema['tableName']}"
+"""
+        + _SYSTEM_PROMPT_RULES_TAIL
+    )
 
-RESPONSE FORMAT:
-Always return valid JSON (no markdown code blocks). Use one of these two formats:
 
-1. When the user asks a data question (queries, analysis, aggregations, filters, etc.):
-{{"type": "sql", "sql": "SELECT ...", "explanation": "..."}}
+def _normalize_messages(messages: list) -> list[dict] | None:
+    """Validate chat history and return it as plain {role, content} dicts.
 
-2. When the user is chatting (greetings, reactions, follow-up clarifications, thanks, etc.):
-{{"type": "chat", "message": "your friendly response here"}}
+    Returns None if any entry is not an object with a user/assistant role and
+    string content, so malformed bodies are rejected before any work is done.
+    """
+    normalized = []
+    for msg in messages:
+        if not isinstance(msg, dict):
+            return None
+        role = msg.get("role")
+        content = msg.get("content")
+        if role not in VALID_ROLES or not isinstance(content, str):
+            return None
+        normalized.append({"role": role, "content": content})
+    return normalized
 
-RULES:
-1. Only generate SQL when the user is clearly asking a data question
-2. For casual messages (hi, wow, thanks, ok, etc.), respond conversationally — do NOT generate SQL
-3. Use only SELECT statements (no INSERT/UPDATE/DELETE/DROP)
-4. Always query from "{schema['tableName']}"
-5. Keep SQL concise and readable
-6. Limit results to 100 rows max unless the user asks for more
-7. Use conversation history to understand follow-up questions (e.g. "break that down by month" refers to the previous query)
-8. Do NOT wrap the JSON in markdown code blocks — return raw JSON only"""
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English and SQL)."""
+    return len(text) // 4 + 1
+
+
+def _trim_history(messages: list[dict], budget: int = HISTORY_TOKEN_BUDGET) -> list[dict]:
+    """Keep the most recent messages whose combined size fits the token budget.
+
+    The latest message is always kept so a single long question still goes out.
+    """
+    used = 0
+    start = len(messages)
+    while start > 0:
+        cost = _estimate_tokens(messages[start - 1]["content"])
+        if used + cost > budget and start < len(messages):
+            break
+        used += cost
+        start -= 1
+    return messages[start:]
+
+
+def _schema_key(schema: dict) -> bytes:
+    """Return a stable fingerprint of a schema, independent of key order."""
+    canonical = json.dumps(schema, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).digest()
+
+
+def _cached_system_prompt(schema: dict, key: bytes | None = None) -> str:
+    """Return build_system_prompt(schema), reusing the string for a repeat schema.
+
+    The schema is constant across a conversation, so every turn after the
+    first skips rebuilding the prompt. Bounded to PROMPT_CACHE_SIZE entries.
+    Pass key if the caller already computed _schema_key(schema).
+    """
+    if key is None:
+        key = _schema_key(schema)
+    prompt = _prompt_cache.get(key)
+    if prompt is None:
+        prompt = build_system_prompt(schema)
+        _prompt_cache.put(key, prompt)
+    return prompt
+
+
+def _response_key(schema_key: bytes, messages: list[dict]) -> bytes:
+    """Key a conversation for the response cache.
+
+    The whole (already trimmed) history is part of the key because follow-up
+    questions depend on earlier turns. Whitespace in the latest message is
+    collapsed so trivially re-typed questions hit the same entry.
+    """
+    *history, last = messages
+    last = {"role": last["role"], "content": " ".join(last["content"].split())}
+    digest = hashlib.blake2b(schema_key, digest_size=16)
+    digest.update(dumps([*history, last]))
+    return digest.digest()
 
 
 def parse_llm_response(raw: str) -> dict:
@@ -63,26 +172,23 @@ def parse_llm_response(raw: str) -> dict:
     Handles markdown fences, extracts JSON blocks from surrounding text,
     and validates required keys. Returns a fallback on total failure.
     """
-    text = raw.strip()
+    text = strip_code_fence(raw.strip())
 
-    # Strip markdown code fences if present
-    if text.startswith("```"):
-        lines = text.split("\n")
-        lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        text = "\n".join(lines).strip()
+    # Only a JSON object is accepted, so text without a brace (empty or
+    # plain prose) can skip both parse attempts
+    if "{" not in text:
+        return dict(FALLBACK_RESPONSE)
 
     # Try direct parse first
     parsed = None
     try:
-        parsed = json.loads(text)
+        parsed = loads(text)
     except json.JSONDecodeError:
-        # Try to extract first {...} block via regex
-        match = re.search(r"\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}", text, re.DOTALL)
-        if match:
+        # Try to extract the first balanced {...} block
+        candidate = find_json_object(text)
+        if candidate is not None:
             try:
-                parsed = json.loads(match.group())
+                parsed = loads(candidate)
             except json.JSONDecodeError:
                 pass
 
@@ -98,52 +204,107 @@ def parse_llm_response(raw: str) -> dict:
             return {"sql": "", "explanation": message}
         return dict(FALLBACK_RESPONSE)
 
-    # Ensure required keys with defaults
-    if "sql" not in parsed or not isinstance(parsed.get("sql"), str):
-        parsed["sql"] = ""
-    if "explanation" not in parsed or not isinstance(parsed.get("explanation"), str):
-        parsed["explanation"] = parsed.get("explanation", "No explanation provided.")
+    # Build the result from the two keys we serve; anything else the LLM
+    # emitted (e.g. a chart, which we handle separately now) is dropped
+    sql = parsed.get("sql")
+    explanation = parsed.get("explanation")
+    return {
+        "sql": sql if isinstance(sql, str) else "",
+        "explanation": explanation if isinstance(explanation, str) else "No explanation provided.",
+    }
+
+
+def _parse_cached(content: str) -> dict:
+    """parse_llm_response with memoization on the raw content string.
+
+    Returns a fresh copy so callers can't mutate the cached result.
+    """
+    result = _parse_cache.get(content)
+    if result is None:
+        result = parse_llm_response(content)
+        _parse_cache.put(content, result)
+    return dict(result)
+
+
+def _prompt_cache_key(schema: dict) -> str:
+    """Derive a provider prompt-cache key from the table name and column names."""
+    names = "\x1f".join(col["name"] for col in schema["columns"])
+    # surrogatepass: the bytes are only hashed, and names come from client JSON
+    digest = hashlib.blake2b(
+        f"{schema['tableName']}\x1e{names}".encode("utf-8", "surrogatepass"), digest_size=16
+    )
+    return digest.hexdigest()
+
 
-    # Strip chart if LLM still includes one (we handle charts separately now)
-    parsed.pop("chart", None)
+def _payload_prefix(system_prompt: str, cache_key: str | None) -> bytes:
+    """Return the encoded request body up to (not including) the chat history.
 
-    return parsed
+    Everything except the history is constant for a conversation, so the
+    multi-KB system prompt is JSON-encoded once and reused on later turns.
+    The returned bytes end inside the open "messages" array.
+    """
+    prefix = _payload_prefix_cache.get((system_prompt, cache_key))
+    if prefix is not None:
+        return prefix
+
+    request = {
+        "model": OPENROUTER_MODEL,
+        "temperature": 0.1,
+        "max_tokens": 1024,
+        # Only message.content is read; leave the model's reasoning text out
+        # of the response body instead of downloading and parsing it.
+        "reasoning": {"exclude": True},
+    }
+    if cache_key:
+        request["prompt_cache_key"] = cache_key
+    # The system prompt is the stable prefix of every turn; mark it cacheable
+    # so providers that support prompt caching can serve it from cache.
+    request["messages"] = [{
+        "role": "system",
+        "content": [{
+            "type": "text",
+            "text": system_prompt,
+            "cache_control": {"type": "ephemeral"},
+        }],
+    }]
+
+    # "messages" is the last key, so the encoding ends with "]}"
+    prefix = dumps(request)[:-2]
+    _payload_prefix_cache.put((system_prompt, cache_key), prefix)
+    return prefix
+
+
+def _build_payload(system_prompt: str, messages: list, cache_key: str | None = None) -> bytes:
+    """Encode the OpenRouter request body, splicing the history onto the cached prefix.
+
+    messages must already be plain {role, content} dicts (see
+    _normalize_messages); they are encoded as-is without re-wrapping.
+    """
+    payload = _payload_prefix(system_prompt, cache_key)
+    if messages:
+        payload += b"," + dumps(messages)[1:-1]
+    return payload + b"]}"
 
 
-def call_openrouter(system_prompt: str, messages: list) -> dict:
+def call_openrouter(system_prompt: str, messages: list, cache_key: str | None = None) -> dict:
     api_key = os.environ.get("OPENROUTER_API_KEY", "")
     if not api_key:
         raise ValueError("OPENROUTER_API_KEY environment variable not set")
 
-    api_messages = [{"role": "system", "content": system_prompt}]
-    for msg in messages:
-        api_messages.append({
-            "role": msg["role"],
-            "content": msg["content"],
-        })
-
-    payload = json.dumps({
-        "model": "openai/gpt-oss-120b:free",
-        "messages": api_messages,
-        "temperature": 0.1,
-        "max_tokens": 1024,
-    }).encode("utf-8")
+    payload = _build_payload(system_prompt, messages, cache_key)
 
-    req = urllib.request.Request(
-        "https://openrouter.ai/api/v1/chat/completions",
-        data=payload,
+    body = post_openrouter(
+        payload,
         headers={
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}",
         },
-        method="POST",
+        timeout=30,
     )
-
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        data = json.loads(resp.read().decode("utf-8"))
+    data = loads(body)
 
     content = data["choices"][0]["message"]["content"]
-    return parse_llm_response(content)
+    return _parse_cached(content)
 
 
 class handler(BaseHTTPRequestHandler):
@@ -151,7 +312,10 @@ class handler(BaseHTTPRequestHandler):
         try:
             content_length = int(self.headers.get("Content-Length", 0))
             body = self.rfile.read(content_length)
-            data = json.loads(body.decode("utf-8"))
+            data = loads(body)
+            if not isinstance(data, dict):
+                self._send_error(400, "Invalid JSON in request body")
+                return
 
             schema = data.get("schema")
             messages = data.get("messages", [])
@@ -164,11 +328,29 @@ class handler(BaseHTTPRequestHandler):
                 self._send_error(400, "Missing messages")
                 return
 
-            # Keep last 5 pairs (10 messages) for context window management
-            messages = messages[-10:]
+            if isinstance(messages, list):
+                messages = _normalize_messages(messages)
+            else:
+                messages = None
+            if messages is None:
+                self._send_error(400, "Invalid messages")
+                return
+
+            # Keep as much recent history as fits the context budget
+            messages = _trim_history(messages)
+
+            # Repeat questions over the same dataset skip the LLM round trip
+            schema_key = _schema_key(schema)
+            response_key = _response_key(schema_key, messages)
+            cached = _response_cache.get(response_key)
+            if cached is not None:
+                self._send_json(200, cached)
+                return
 
-            system_prompt = build_system_prompt(schema)
-            result = call_openrouter(system_prompt, messages)
+            system_prompt = _cached_system_prompt(schema, schema_key)
+            result = call_openrouter(system_prompt, messages, _prompt_cache_key(schema))
+            if result != FALLBACK_RESPONSE:
+                _response_cache.put(response_key, result)
 
             self._send_json(200, result)
 
@@ -183,12 +365,29 @@ class handler(BaseHTTPRequestHandler):
             self._send_error(500, f"Internal error: {str(e)}")
 
     def _send_json(self, status: int, data: dict):
-        body = json.dumps(data).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
+        body = dumps(data)
+        # Build status line, headers and body up front so the response goes
+        # out in a single write instead of one for headers and one for body.
+        self.log_request(status)
+        head = (
+            f"{self.protocol_version} {status} {self.responses[status][0]}\r\n"
+            f"Server: {self.version_string()}\r\n"
+            f"Date: {self.date_time_string()}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        )
+        self.wfile.write(head.encode("latin-1") + body)
 
     def _send_error(self, status: int, message: str):
         self._send_json(status, {"error": message})
+
+
+if __name__ == "__main__":
+    # Local development server. Requests are served on separate threads so a
+    # slow LLM call does not block other chats; the connection pool and caches
+    # above are lock-protected. On Vercel each invocation gets its own handler.
+    from http.server import ThreadingHTTPServer
+
+    port = int(os.environ.get("PORT", "8000"))
+    ThreadingHTTPServer(("127.0.0.1", port), handler).serve_forever()
@@ -1,20 +1,83 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler
+import atexit
+import hashlib
 import json
+import logging
+import logging.handlers
 import os
+import queue
 import re
 import sys
-import traceback
-import urllib.request
+import threading
+import urllib.error
 
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+
+from api._openrouter import LRUCache, dumps, loads, post_openrouter, prompt_value, strip_code_fence
+from api._plot_sandbox import compile_plot_code, encode_response, run_plot
+
+
+def _log_level(name: str) -> int:
+    """The logging level called name, or INFO if there is no such level."""
+    level = logging.getLevelName(name.upper())
+    return level if isinstance(level, int) else logging.INFO
+
+
+log = logging.getLogger("insights")
+if not log.handlers:
+    # Request threads only enqueue records; a listener thread does the
+    # stderr writes, so concurrent requests do not contend on its lock
+    _log_handler = logging.StreamHandler(sys.stderr)
+    _log_handler.setFormatter(logging.Formatter("[%(name)s] %(levelname)s %(message)s"))
+    _log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    log.addHandler(logging.handlers.QueueHandler(_log_queue))
+    log.propagate = False
+    # Per-request diagnostics are DEBUG; set INSIGHTS_LOG_LEVEL=DEBUG to see them
+    log.setLevel(_log_level(os.environ.get("INSIGHTS_LOG_LEVEL", "INFO")))
 
 FALLBACK_PLAN = {"queries": []}
 FALLBACK_INSIGHTS = {
     "summary": "Unable to generate insights. Please try again.",
     "insights": [],
 }
+VALID_PRIORITIES = {"high", "medium", "low"}
+
+# String literals (matched whole), braces, and a lone quote for an
+# unterminated string; used to walk JSON structure without a per-char loop
+_JSON_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}"]', re.DOTALL)
+# Whitespace and commas between items of a JSON array
+_ITEM_GAP_RE = re.compile(r"[ \t\n\r,]*")
+_INSIGHTS_ARRAY_RE = re.compile(r'"insights"\s*:\s*\[')
+# Summary string in a possibly truncated synthesize response
+_SUMMARY_RE = re.compile(r'"summary"\s*:\s*"((?:[^"\\]|\\.)*)"')
+# Outermost [...] span, for plans returned as a bare array
+_PLAN_ARRAY_RE = re.compile(r"\[.*\]", re.DOTALL)
+
+_json_decoder = json.JSONDecoder()
+
+COMPLETION_CACHE_SIZE = 512
+PROMPT_CACHE_SIZE = 128
+CODE_CACHE_SIZE = 256
+CHART_WORKERS = 6
+# Result rows shown to the model per query in the synthesize prompt
+PROMPT_MAX_ROWS = 20
+# Total characters of result rows across all queries in the synthesize prompt;
+# each query gets an equal share of whatever earlier queries left unused
+PROMPT_RESULTS_BUDGET = 32_000
+# Sample rows shown in the plan prompt (the client sends LIMIT 10)
+PLAN_MAX_SAMPLE_ROWS = 10
+
+
+# Raw LLM completions keyed by a digest of the full request
+_completion_cache = LRUCache(COMPLETION_CACHE_SIZE)
+# Compiled plot functions keyed by source
+_code_cache = LRUCache(CODE_CACHE_SIZE)
+# Plan prompts keyed by _schema_key
+_plan_prompt_cache = LRUCache(PROMPT_CACHE_SIZE)
 
 PLOTLY_SCOPE_DOC = """AVAILABLE SCOPE for visualization code (these variables are already defined — do NOT import anything):
 - df: a pandas DataFrame containing the query result rows for this insight
@@ -28,19 +91,19 @@ Use px.imshow for heatmaps/matrices, px.bar for bar charts, px.line for line cha
 Do NOT set template, font colors, paper_bgcolor, or plot_bgcolor — the frontend handles all theming."""
 
 
+def _columns_desc(schema: dict) -> str:
+    return "\n".join(f"- {col['name']} ({col['type']})" for col in schema["columns"])
+
+
 def build_plan_prompt(schema: dict) -> str:
-    columns_desc = "\n".join(
-        f"- {col['name']} ({col['type']})" for col in schema["columns"]
-    )
+    columns_desc = _columns_desc(schema)
 
-    header = " | ".join(col["name"] for col in schema["columns"])
-    sample_lines = []
-    for row in schema.get("sampleRows", []):
-        vals = " | ".join(
-            str(row.get(col["name"], "NULL")) for col in schema["columns"]
-        )
-        sample_lines.append(f"| {vals} |")
-    sample_rows = "\n".join(sample_lines)
+    names = [col["name"] for col in schema["columns"]]
+    header = " | ".join(names)
+    sample_rows = "\n".join(
+        "| " + " | ".join([prompt_value(row.get(name, "NULL")) for name in names]) + " |"
+        for row in schema.get("sampleRows", [])[:PLAN_MAX_SAMPLE_ROWS]
+    )
 
     return f"""You are a data analyst. Analyze this dataset and create an analysis plan.
 
@@ -76,54 +139,39 @@ RULES:
 5. Return raw JSON only, no markdown code blocks"""
 
 
-def build_synthesize_prompt(schema: dict, plan_with_results: list) -> str:
-    columns_desc = "\n".join(
-        f"- {col['name']} ({col['type']})" for col in schema["columns"]
-    )
-
-    results_text = ""
-    for item in plan_with_results:
-        results_text += f"\n### {item['title']} (id: {item['id']})\n"
-        results_text += f"SQL: {item['sql']}\n"
-        if item.get("error"):
-            results_text += f"ERROR: {item['error']}\n"
-        elif item.get("result"):
-            result = item["result"]
-            cols = result.get("columns", [])
-            rows = result.get("rows", [])
-            if cols and rows:
-                results_text += f"Columns: {', '.join(cols)}\n"
-                for row in rows[:20]:
-                    vals = " | ".join(str(row.get(c, "NULL")) for c in cols)
-                    results_text += f"  {vals}\n"
-            else:
-                results_text += "No results returned.\n"
+def _schema_key(schema: dict) -> bytes:
+    """Return a stable fingerprint of a schema, independent of key order."""
+    canonical = json.dumps(schema, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).digest()
 
-    return f"""You are a senior data analyst. Based on the query results below, produce prioritized business insights.
 
-TABLE: {schema['tableName']}
-COLUMNS:
-{columns_desc}
+def _cached_plan_prompt(schema: dict) -> str:
+    """Return build_plan_prompt(schema), reusing the string for a repeat schema."""
+    key = _schema_key(schema)
+    prompt = _plan_prompt_cache.get(key)
+    if prompt is None:
+        prompt = build_plan_prompt(schema)
+        _plan_prompt_cache.put(key, prompt)
+    return prompt
 
-QUERY RESULTS:
-{results_text}
 
-{PLOTLY_SCOPE_DOC}
+# Static tail of the synthesize prompt, built once at import
+_SYNTHESIZE_INSTRUCTIONS = PLOTLY_SCOPE_DOC + """
 
 Return ONLY valid JSON (no markdown fences) with this structure:
-{{
+{
   "summary": "2-3 sentence executive summary of the dataset",
   "insights": [
-    {{
+    {
       "title": "Concise insight title",
       "priority": "high|medium|low",
       "finding": "Detailed explanation of the insight and its business implications",
       "sql": "The SQL query that produced this insight",
       "pythonCode": "fig = px.bar(df, x='col1', y='col2', title='My Chart')",
       "chartTitle": "Chart title"
-    }}
+    }
   ]
-}}
+}
 
 RULES:
 1. Produce 3-6 insights, sorted by business impact (high priority first)
@@ -137,61 +185,123 @@ RULES:
 9. Return raw JSON only, no markdown code blocks"""
 
 
-def _extract_json_object(text: str) -> dict | None:
-    """Extract the first top-level JSON object from text using brace counting."""
-    start = text.find("{")
-    if start == -1:
-        return None
+def build_synthesize_prompt(schema: dict, plan_with_results: list) -> str:
+    columns_desc = _columns_desc(schema)
+
+    # Collect pieces and join once; += on a str copies it every time
+    parts = []
+    budget = PROMPT_RESULTS_BUDGET
+    # Queries still to print rows; splitting the budget between them keeps a
+    # wide early result from starving the ones after it
+    remaining = sum(
+        1 for item in plan_with_results
+        if not item.get("error") and item.get("result")
+        and item["result"].get("columns") and item["result"].get("rows")
+    )
+    for item in plan_with_results:
+        parts.append(f"\n### {item['title']} (id: {item['id']})\n")
+        parts.append(f"SQL: {item['sql']}\n")
+        if item.get("error"):
+            parts.append(f"ERROR: {item['error']}\n")
+        elif item.get("result"):
+            result = item["result"]
+            cols = result.get("columns", [])
+            rows = result.get("rows", [])
+            if cols and rows:
+                parts.append(f"Columns: {', '.join(cols)}\n")
+                share = budget // remaining
+                remaining -= 1
+                # Repeated rows tell the model nothing new, so they do not
+                # count toward the row limit
+                seen = set()
+                for i, row in enumerate(rows):
+                    line = " | ".join([prompt_value(row.get(c, "NULL")) for c in cols])
+                    if line in seen:
+                        continue
+                    if len(line) > share:
+                        parts.append(f"  … ({len(rows) - i} more rows omitted)\n")
+                        break
+                    share -= len(line)
+                    budget -= len(line)
+                    seen.add(line)
+                    parts.append(f"  {line}\n")
+                    if len(seen) == PROMPT_MAX_ROWS:
+                        break
+            else:
+                parts.append("No results returned.\n")
+    results_text = "".join(parts)
+
+    return f"""You are a senior data analyst. Based on the query results below, produce prioritized business insights.
+
+TABLE: {schema['tableName']}
+COLUMNS:
+{columns_desc}
+
+QUERY RESULTS:
+{results_text}
+
+""" + _SYNTHESIZE_INSTRUCTIONS
+
+
+def _balanced_object_end(text: str, start: int) -> int | None:
+    """Return the index just past the {...} opening at text[start], or None.
+
+    Walks only string literals and braces via _JSON_TOKEN_RE, so the regex
+    engine skips everything else (including whole strings) in C instead of
+    stepping through the text one character at a time in Python. Returns None
+    if the object is never closed, e.g. because the response was truncated.
+    """
     depth = 0
-    in_string = False
-    escape = False
-    for i in range(start, len(text)):
-        ch = text[i]
-        if escape:
-            escape = False
-            continue
-        if ch == "\\":
-            if in_string:
-                escape = True
-            continue
-        if ch == '"' and not escape:
-            in_string = not in_string
-            continue
-        if in_string:
-            continue
-        if ch == "{":
+    for match in _JSON_TOKEN_RE.finditer(text, start):
+        token = match.group()
+        if token == "{":
             depth += 1
-        elif ch == "}":
+        elif token == "}":
             depth -= 1
             if depth == 0:
-                try:
-                    return json.loads(text[start : i + 1])
-                except json.JSONDecodeError:
-                    return None
+                return match.end()
+        elif token == '"':
+            # Unterminated string literal: the object cannot close
+            return None
+    return None
+
+
+def _extract_json_object(text: str) -> dict | None:
+    """Extract the first decodable top-level JSON object embedded in text.
+
+    raw_decode runs the C scanner from the candidate "{" and reports where
+    the object ends, so the common case needs no separate brace matching.
+    A balanced but invalid candidate is skipped whole; an unclosed one
+    means the text was truncated.
+    """
+    start = text.find("{")
+    while start != -1:
+        try:
+            return _json_decoder.raw_decode(text, start)[0]
+        except json.JSONDecodeError:
+            end = _balanced_object_end(text, start)
+            if end is None:
+                return None
+            start = text.find("{", end)
     return None
 
 
 def parse_plan_response(raw: str) -> dict:
     text = raw.strip()
 
-    if text.startswith("```"):
-        lines = text.split("\n")
-        lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        text = "\n".join(lines).strip()
+    text = strip_code_fence(text)
 
     parsed = None
     try:
-        parsed = json.loads(text)
+        parsed = loads(text)
     except json.JSONDecodeError:
         parsed = _extract_json_object(text)
 
     if not isinstance(parsed, dict):
-        match = re.search(r"\[.*\]", text, re.DOTALL)
+        match = _PLAN_ARRAY_RE.search(text)
         if match:
             try:
-                arr = json.loads(match.group())
+                arr = loads(match.group())
                 if isinstance(arr, list):
                     return {"queries": arr}
             except json.JSONDecodeError:
@@ -200,10 +310,11 @@ def parse_plan_response(raw: str) -> dict:
 
     queries = parsed.get("queries")
     if not isinstance(queries, list):
-        for key, val in parsed.items():
-            if isinstance(val, list) and len(val) > 0 and isinstance(val[0], dict):
-                queries = val
-                break
+        # Models sometimes pick their own key; take the first list of objects
+        queries = next(
+            (val for val in parsed.values() if isinstance(val, list) and val and isinstance(val[0], dict)),
+            None,
+        )
     if not isinstance(queries, list):
         return dict(FALLBACK_PLAN)
 
@@ -233,7 +344,7 @@ def parse_plan_response(raw: str) -> dict:
 
 def _extract_summary(text: str) -> str:
     """Extract the summary string from potentially truncated JSON."""
-    match = re.search(r'"summary"\s*:\s*"((?:[^"\\]|\\.)*)"', text)
+    match = _SUMMARY_RE.search(text)
     if match:
         return match.group(1)
     return "Analysis complete."
@@ -246,150 +357,260 @@ def _extract_insight_objects(text: str) -> list[dict]:
     so even if the response is truncated mid-array we salvage the finished items.
     """
     # Find the start of the insights array
-    arr_match = re.search(r'"insights"\s*:\s*\[', text)
+    arr_match = _INSIGHTS_ARRAY_RE.search(text)
     if not arr_match:
         return []
+    return _scan_insight_objects(text, arr_match.end())[0]
 
-    pos = arr_match.end()
+
+def _scan_insight_objects(text: str, pos: int) -> tuple[list[dict], int]:
+    """Parse the complete array items from text[pos:].
+
+    Returns the objects and the position to resume from once more text has
+    arrived (the start of the first unfinished item).
+    """
     objects = []
 
     while pos < len(text):
         # Skip whitespace and commas
-        while pos < len(text) and text[pos] in " \t\n\r,":
-            pos += 1
+        pos = _ITEM_GAP_RE.match(text, pos).end()
         if pos >= len(text) or text[pos] != "{":
             break
 
-        # Brace-count to find the matching close brace
-        depth = 0
-        in_string = False
-        escape = False
-        start = pos
-        for i in range(start, len(text)):
-            ch = text[i]
-            if escape:
-                escape = False
-                continue
-            if ch == "\\":
-                if in_string:
-                    escape = True
-                continue
-            if ch == '"' and not escape:
-                in_string = not in_string
-                continue
-            if in_string:
-                continue
-            if ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    candidate = text[start : i + 1]
-                    try:
-                        objects.append(json.loads(candidate))
-                    except json.JSONDecodeError:
-                        pass
-                    pos = i + 1
-                    break
-        else:
-            # Reached end of text without closing brace — truncated, stop
-            break
+        try:
+            obj, pos = _json_decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            # Either truncated or a malformed item; skip the latter whole
+            end = _balanced_object_end(text, pos)
+            if end is None:
+                # Reached end of text without closing brace — truncated, stop
+                break
+            pos = end
+            continue
+        objects.append(obj)
 
-    return objects
+    return objects, pos
 
 
-def parse_insights_response(raw: str) -> dict:
-    text = raw.strip()
+class _InsightScanner:
+    """Pick validated insights out of a streamed completion as they finish.
 
-    if text.startswith("```"):
-        lines = text.split("\n")
-        lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        text = "\n".join(lines).strip()
+    feed() takes the whole text received so far and returns the
+    (index, insight) pairs completed since the previous call, numbered the
+    same way parse_insights_response numbers the final list.
+    """
 
-    # Try clean parse first
-    parsed = None
+    def __init__(self):
+        self._pos: int | None = None
+        self._seen = 0
+        self._count = 0
+
+    def feed(self, text: str) -> list[tuple[int, dict]]:
+        # An item can only have finished if a closing brace arrived
+        fresh = text.find("}", self._seen) != -1
+        self._seen = len(text)
+        if not fresh:
+            return []
+        if self._pos is None:
+            match = _INSIGHTS_ARRAY_RE.search(text)
+            if not match:
+                return []
+            self._pos = match.end()
+
+        objects, self._pos = _scan_insight_objects(text, self._pos)
+        completed = []
+        for item in objects:
+            entry = _normalize_insight(item)
+            if entry is not None:
+                completed.append((self._count, entry))
+                self._count += 1
+        return completed
+
+
+def _is_insights_doc(parsed) -> bool:
+    return isinstance(parsed, dict) and isinstance(parsed.get("insights"), list)
+
+
+def parse_insights_response(raw: str) -> dict:
+    # Fast path: most responses are bare JSON, so try them as-is before any
+    # fence stripping or salvage work
     try:
-        parsed = json.loads(text)
+        parsed = loads(raw)
     except json.JSONDecodeError:
-        parsed = _extract_json_object(text)
+        parsed = None
+
+    if not _is_insights_doc(parsed):
+        text = raw.strip()
+
+        text = strip_code_fence(text)
+
+        try:
+            parsed = loads(text)
+        except json.JSONDecodeError:
+            parsed = _extract_json_object(text)
 
     # If clean parse succeeded, use the insights array directly
-    if isinstance(parsed, dict) and isinstance(parsed.get("insights"), list):
+    if _is_insights_doc(parsed):
         insights_raw = parsed["insights"]
         summary = parsed.get("summary", "")
     else:
         # Truncated response: salvage what we can
-        print("[insights] JSON truncated — attempting partial extraction", file=sys.stderr)
+        log.warning("JSON truncated — attempting partial extraction")
         summary = _extract_summary(text)
         insights_raw = _extract_insight_objects(text)
 
     if not isinstance(summary, str) or not summary:
         summary = "Analysis complete."
 
-    valid_priorities = {"high", "medium", "low"}
     valid = []
     for item in insights_raw:
-        if not isinstance(item, dict):
-            continue
-        if not isinstance(item.get("title"), str):
-            continue
-        if not isinstance(item.get("finding"), str):
-            continue
+        entry = _normalize_insight(item)
+        if entry is not None:
+            valid.append(entry)
 
-        priority = item.get("priority", "medium")
-        if priority not in valid_priorities:
-            priority = "medium"
+    return {"summary": summary, "insights": valid}
 
-        entry = {
-            "title": item["title"],
-            "priority": priority,
-            "finding": item["finding"],
-            "sql": item.get("sql", ""),
-        }
 
-        python_code = item.get("pythonCode")
-        if isinstance(python_code, str) and python_code.strip():
-            entry["pythonCode"] = python_code
-            chart_title = item.get("chartTitle")
-            if isinstance(chart_title, str) and chart_title.strip():
-                entry["chartTitle"] = chart_title
+def _normalize_insight(item) -> dict | None:
+    """Validate one raw insight object, or return None to drop it."""
+    if not isinstance(item, dict):
+        return None
+    if not isinstance(item.get("title"), str):
+        return None
+    if not isinstance(item.get("finding"), str):
+        return None
 
-        valid.append(entry)
+    priority = item.get("priority", "medium")
+    if priority not in VALID_PRIORITIES:
+        priority = "medium"
 
-    return {"summary": summary, "insights": valid}
+    entry = {
+        "title": item["title"],
+        "priority": priority,
+        "finding": item["finding"],
+        "sql": item.get("sql", ""),
+    }
+
+    python_code = item.get("pythonCode")
+    if isinstance(python_code, str) and python_code.strip():
+        entry["pythonCode"] = python_code
+        chart_title = item.get("chartTitle")
+        if isinstance(chart_title, str) and chart_title.strip():
+            entry["chartTitle"] = chart_title
+
+    return entry
+
+
+def _compile_plot_code(python_code: str):
+    """compile_plot_code, cached per source."""
+    fn = _code_cache.get(python_code)
+    if fn is None:
+        fn = compile_plot_code(python_code, "<insight>")
+        _code_cache.put(python_code, fn)
+    return fn
 
 
 def execute_plot_code(python_code: str, df: pd.DataFrame) -> dict:
-    """Execute LLM-generated Python code in a restricted sandbox and return Plotly JSON."""
-    allowed_globals = {
-        "__builtins__": {},
-        "pd": pd,
-        "px": px,
-        "go": go,
-        "df": df,
-        "print": lambda *a, **k: None,
-    }
+    """Execute LLM-generated Python code in a restricted sandbox and return the Plotly figure dict.
+
+    The dict may hold numpy values; encode it with encode_response.
+    """
+    return run_plot(_compile_plot_code(python_code), df)
 
-    exec(python_code, allowed_globals)
 
-    fig = allowed_globals.get("fig")
-    if fig is None:
-        raise ValueError("Code did not produce a `fig` variable")
+def _normalize_sql(s: str) -> str:
+    return " ".join(s.lower().split())
 
-    if not isinstance(fig, go.Figure):
-        raise ValueError(f"fig is not a plotly Figure (got {type(fig).__name__})")
 
-    return json.loads(fig.to_json())
+class _PlanResultIndex:
+    """Find the plan query result an insight's SQL refers to.
 
+    Matches by normalized SQL first, then by one SQL containing the other,
+    and finally falls back to the insight's position in the plan. A fragment
+    found in more than one plan query (e.g. just "FROM sales GROUP BY") is
+    ambiguous and goes to the positional fallback.
 
-def call_openrouter(system_prompt: str, user_message: str, max_tokens: int = 1024) -> str:
+    Plan SQL is normalized once here. The substring pass is a plain scan:
+    with a handful of plan queries it costs microseconds per synthesize
+    call, and a token index would still need the substring check to keep
+    fragment matches exact.
+    """
+
+    def __init__(self, plan_with_results: list):
+        self.by_sql: dict[str, dict] = {}
+        self.results: list[dict] = []
+        for item in plan_with_results:
+            if item.get("result") and item["result"].get("rows"):
+                self.by_sql[_normalize_sql(item["sql"])] = item["result"]
+                self.results.append(item["result"])
+
+    def find(self, insight_sql: str, idx: int) -> dict | None:
+        norm = _normalize_sql(insight_sql) if isinstance(insight_sql, str) else ""
+        query_result = self.by_sql.get(norm)
+
+        # An empty string is a substring of every plan SQL
+        if not query_result and norm:
+            matches = [
+                result for plan_sql, result in self.by_sql.items()
+                if norm in plan_sql or plan_sql in norm
+            ]
+            if len(matches) == 1:
+                query_result = matches[0]
+
+        if not query_result and idx < len(self.results):
+            # Last resort: use positional index
+            query_result = self.results[idx]
+        return query_result
+
+
+def _render_chart(python_code: str, query_result: dict) -> dict:
+    """Build the result DataFrame and run an insight's plot code against it."""
+    # The column list keeps result order regardless of row dict key order
+    df = pd.DataFrame(query_result["rows"], columns=query_result.get("columns") or None)
+    return execute_plot_code(python_code, df)
+
+
+def _read_stream(resp, on_content) -> tuple[str, str]:
+    """Accumulate delta content from an SSE completion stream.
+
+    Calls on_content with the full text received so far after every delta
+    and returns the final content and finish_reason.
+    """
+    content = ""
+    finish_reason = ""
+    for line in resp:
+        # Skip blank event separators and ": OPENROUTER PROCESSING" comments
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+        chunk = loads(data)
+        if "error" in chunk:
+            error = chunk["error"]
+            message = error.get("message", error) if isinstance(error, dict) else error
+            raise ValueError(f"LLM stream error: {message}")
+        choices = chunk.get("choices") or [{}]
+        delta = (choices[0].get("delta") or {}).get("content")
+        if delta:
+            content += delta
+            on_content(content)
+        finish_reason = choices[0].get("finish_reason") or finish_reason
+    return content, finish_reason
+
+
+def call_openrouter(system_prompt: str, user_message: str, max_tokens: int = 1024, on_content=None) -> str:
+    """Return the completion text for one system/user exchange.
+
+    With on_content the completion is streamed and on_content is called with
+    the text received so far as it grows; a cached completion is returned
+    without any callbacks.
+    """
     api_key = os.environ.get("OPENROUTER_API_KEY", "")
     if not api_key:
         raise ValueError("OPENROUTER_API_KEY environment variable not set")
 
-    payload = json.dumps({
+    request = {
         "model": "openai/gpt-oss-120b:free",
         "messages": [
             {"role": "system", "content": system_prompt},
@@ -397,35 +618,61 @@ def call_openrouter(system_prompt: str, user_message: str, max_tokens: int = 102
         ],
         "temperature": 0.1,
         "max_tokens": max_tokens,
-    }).encode("utf-8")
-
-    req = urllib.request.Request(
-        "https://openrouter.ai/api/v1/chat/completions",
-        data=payload,
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        method="POST",
-    )
+    }
+    payload = dumps(request)
+
+    # Re-running analysis on the same dataset sends an identical request;
+    # serve the stored completion instead of another multi-second round trip.
+    cache_key = hashlib.sha256(payload).digest()
+    cached = _completion_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    if on_content is not None:
+        request["stream"] = True
+        payload = dumps(request)
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
 
-    with urllib.request.urlopen(req, timeout=60) as resp:
-        data = json.loads(resp.read().decode("utf-8"))
+    if on_content is not None:
+        content, finish_reason = post_openrouter(
+            payload, headers, 60, lambda resp: _read_stream(resp, on_content)
+        )
+    else:
+        data = loads(post_openrouter(payload, headers, 60))
+        choice = data["choices"][0]
+        content = choice["message"]["content"]
+        finish_reason = choice.get("finish_reason", "")
 
-    choice = data["choices"][0]
-    content = choice["message"]["content"]
-    finish_reason = choice.get("finish_reason", "")
     if finish_reason == "length":
-        print(f"[insights] WARNING: response truncated (finish_reason=length, len={len(content)})", file=sys.stderr)
+        log.warning("response truncated (finish_reason=length, len=%d)", len(content))
+    else:
+        _completion_cache.put(cache_key, content)
     return content
 
 
+# Bodies for fixed responses, encoded once at import
+_FALLBACK_PLAN_BODY = encode_response(FALLBACK_PLAN)
+_STATIC_ERROR_BODIES = {
+    message: encode_response({"error": message})
+    for message in (
+        "Missing schema",
+        "Missing planWithResults",
+        "Invalid phase: must be 'plan' or 'synthesize'",
+        "Invalid JSON in request body",
+    )
+}
+
+
 class handler(BaseHTTPRequestHandler):
     def do_POST(self):
         try:
             content_length = int(self.headers.get("Content-Length", 0))
             body = self.rfile.read(content_length)
-            data = json.loads(body.decode("utf-8"))
+            data = loads(body)
 
             phase = data.get("phase")
             schema = data.get("schema")
@@ -456,74 +703,88 @@ class handler(BaseHTTPRequestHandler):
             self._send_error(500, f"Internal error: {str(e)}")
 
     def _handle_plan(self, schema: dict):
-        system_prompt = build_plan_prompt(schema)
+        system_prompt = _cached_plan_prompt(schema)
         raw = call_openrouter(system_prompt, "Analyze this dataset and create an analysis plan.", max_tokens=4096)
-        print(f"[insights] plan raw LLM response ({len(raw)} chars): {raw[:500]}", file=sys.stderr)
+        log.debug("plan raw LLM response (%d chars): %.500s", len(raw), raw)
         result = parse_plan_response(raw)
-        print(f"[insights] plan parsed: {len(result.get('queries', []))} queries", file=sys.stderr)
+        log.debug("plan parsed: %d queries", len(result.get("queries", [])))
+        if not result["queries"]:
+            self._send_bytes(200, _FALLBACK_PLAN_BODY)
+            return
         self._send_json(200, result)
 
     def _handle_synthesize(self, schema: dict, plan_with_results: list):
-        n_results = sum(1 for q in plan_with_results if q.get("result"))
-        n_errors = sum(1 for q in plan_with_results if q.get("error"))
-        print(f"[insights] synthesize input: {len(plan_with_results)} queries ({n_results} with results, {n_errors} with errors)", file=sys.stderr)
+        if log.isEnabledFor(logging.DEBUG):
+            n_results = sum(1 for q in plan_with_results if q.get("result"))
+            n_errors = sum(1 for q in plan_with_results if q.get("error"))
+            log.debug("synthesize input: %d queries (%d with results, %d with errors)", len(plan_with_results), n_results, n_errors)
         system_prompt = build_synthesize_prompt(schema, plan_with_results)
-        raw = call_openrouter(system_prompt, "Synthesize the query results into prioritized business insights.", max_tokens=8192)
-        print(f"[insights] synthesize raw LLM response ({len(raw)} chars): {raw[:500]}", file=sys.stderr)
-        result = parse_insights_response(raw)
-        n_with_code = sum(1 for i in result.get("insights", []) if i.get("pythonCode"))
-        print(f"[insights] synthesize parsed: {len(result.get('insights', []))} insights ({n_with_code} with pythonCode)", file=sys.stderr)
-
-        # Build a lookup of plan results by SQL (normalized) and by index
-        def _normalize_sql(s: str) -> str:
-            return " ".join(s.lower().split())
-
-        plan_results_by_sql: dict[str, dict] = {}
-        plan_results_list: list[dict] = []
-        for item in plan_with_results:
-            if item.get("result") and item["result"].get("rows"):
-                plan_results_by_sql[_normalize_sql(item["sql"])] = item["result"]
-                plan_results_list.append(item["result"])
-
-        # Execute Python code for each insight that has it
-        for idx, insight in enumerate(result.get("insights", [])):
-            python_code = insight.pop("pythonCode", None)
-            if not python_code:
-                continue
+        plan_index = _PlanResultIndex(plan_with_results)
+        # Chart futures keyed by (insight index, plot code); None when the
+        # insight has no usable data
+        charts: dict[tuple[int, str], Future | None] = {}
+
+        with ThreadPoolExecutor(max_workers=CHART_WORKERS) as pool:
+            def submit_chart(idx: int, insight: dict) -> None:
+                python_code = insight.get("pythonCode")
+                if not python_code or (idx, python_code) in charts:
+                    return
+                charts[idx, python_code] = None
 
-            try:
-                # Try exact match first, then normalized match, then index fallback
-                insight_sql = insight.get("sql", "")
-                query_result = plan_results_by_sql.get(_normalize_sql(insight_sql))
-
-                if not query_result:
-                    # Fuzzy: find plan item whose SQL is a substring or contains insight SQL
-                    norm_insight = _normalize_sql(insight_sql)
-                    for plan_sql, plan_result in plan_results_by_sql.items():
-                        if norm_insight in plan_sql or plan_sql in norm_insight:
-                            query_result = plan_result
-                            break
-
-                if not query_result and idx < len(plan_results_list):
-                    # Last resort: use positional index
-                    query_result = plan_results_list[idx]
+                try:
+                    query_result = plan_index.find(insight.get("sql", ""), idx)
+                except Exception:
+                    log.warning("lookup error for insight '%s'", insight.get("title", "?"), exc_info=True)
+                    return
 
                 if not query_result or not query_result.get("rows"):
-                    print(f"[insights] no data found for insight '{insight.get('title', '?')}', skipping chart", file=sys.stderr)
-                    continue
+                    log.debug("no data found for insight '%s', skipping chart", insight.get("title", "?"))
+                    return
 
-                df = pd.DataFrame(query_result["rows"])
-                plotly_spec = execute_plot_code(python_code, df)
-                insight["plotlySpec"] = plotly_spec
-                print(f"[insights] chart generated for insight '{insight.get('title', '?')}'", file=sys.stderr)
-            except Exception as e:
-                print(f"[insights] exec error for insight '{insight.get('title', '?')}': {traceback.format_exc()}", file=sys.stderr)
-                # Non-critical: just skip the chart
+                charts[idx, python_code] = pool.submit(_render_chart, python_code, query_result)
+
+            # Start rendering each chart as soon as its insight has streamed
+            # in, while the model is still writing the later ones
+            scanner = _InsightScanner()
+
+            def on_content(text: str) -> None:
+                for idx, insight in scanner.feed(text):
+                    submit_chart(idx, insight)
+
+            raw = call_openrouter(
+                system_prompt,
+                "Synthesize the query results into prioritized business insights.",
+                max_tokens=8192,
+                on_content=on_content,
+            )
+            log.debug("synthesize raw LLM response (%d chars): %.500s", len(raw), raw)
+            result = parse_insights_response(raw)
+            if log.isEnabledFor(logging.DEBUG):
+                n_with_code = sum(1 for i in result.get("insights", []) if i.get("pythonCode"))
+                log.debug("synthesize parsed: %d insights (%d with pythonCode)", len(result.get("insights", [])), n_with_code)
+
+            # Covers cached completions and anything the scanner missed
+            for idx, insight in enumerate(result.get("insights", [])):
+                submit_chart(idx, insight)
+
+            for idx, insight in enumerate(result.get("insights", [])):
+                python_code = insight.pop("pythonCode", None)
+                future = charts.get((idx, python_code)) if python_code else None
+                if future is None:
+                    continue
+                try:
+                    insight["plotlySpec"] = future.result()
+                    log.debug("chart generated for insight '%s'", insight.get("title", "?"))
+                except Exception:
+                    log.warning("exec error for insight '%s'", insight.get("title", "?"), exc_info=True)
+                    # Non-critical: just skip the chart
 
         self._send_json(200, result)
 
     def _send_json(self, status: int, data: dict):
-        body = json.dumps(data).encode("utf-8")
+        self._send_bytes(status, encode_response(data))
+
+    def _send_bytes(self, status: int, body: bytes):
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(body)))
@@ -531,4 +792,7 @@ class handler(BaseHTTPRequestHandler):
         self.wfile.write(body)
 
     def _send_error(self, status: int, message: str):
-        self._send_json(status, {"error": message})
+        body = _STATIC_ERROR_BODIES.get(message)
+        if body is None:
+            body = encode_response({"error": message})
+        self._send_bytes(status, body)
@@ -1,6 +1,19 @@
+import io
 import json
 import pytest
-from api.chat import build_system_prompt, parse_llm_response
+from api.chat import (
+    handler,
+    build_system_prompt,
+    parse_llm_response,
+    _cached_system_prompt,
+    _normalize_messages,
+    _prompt_cache_key,
+    _build_payload,
+    _response_key,
+    _schema_key,
+    _trim_history,
+    OPENROUTER_MODEL,
+)
 
 
 SAMPLE_SCHEMA = {
@@ -49,6 +62,119 @@ class TestBuildSystemPrompt:
         assert "yKey" not in prompt
 
 
+class TestCachedSystemPrompt:
+    def test_matches_uncached_prompt(self):
+        assert _cached_system_prompt(SAMPLE_SCHEMA) == build_system_prompt(SAMPLE_SCHEMA)
+
+    def test_repeat_schema_reuses_prompt(self):
+        first = _cached_system_prompt(SAMPLE_SCHEMA)
+        reordered = dict(reversed(list(SAMPLE_SCHEMA.items())))
+        assert _cached_system_prompt(reordered) is first
+
+    def test_different_schema_gets_own_prompt(self):
+        other = {**SAMPLE_SCHEMA, "tableName": "orders"}
+        assert "TABLE: orders" in _cached_system_prompt(other)
+        assert "TABLE: sales" in _cached_system_prompt(SAMPLE_SCHEMA)
+
+
+class TestNormalizeMessages:
+    def test_keeps_only_role_and_content(self):
+        messages = [{"role": "user", "content": "hi", "id": "1", "sql": "SELECT 1"}]
+        assert _normalize_messages(messages) == [{"role": "user", "content": "hi"}]
+
+    def test_rejects_unknown_role(self):
+        assert _normalize_messages([{"role": "system", "content": "hi"}]) is None
+
+    def test_rejects_non_string_content(self):
+        assert _normalize_messages([{"role": "user", "content": None}]) is None
+
+    def test_rejects_non_object_entries(self):
+        assert _normalize_messages(["hi"]) is None
+
+
+class TestBuildPayload:
+    def test_splices_history_after_system_message(self):
+        messages = [
+            {"role": "user", "content": "total sales?"},
+            {"role": "assistant", "content": "SELECT SUM(amount) FROM sales"},
+        ]
+        payload = json.loads(_build_payload("SYSTEM", messages, "abc"))
+        assert payload["model"] == OPENROUTER_MODEL
+        assert payload["prompt_cache_key"] == "abc"
+        assert payload["reasoning"] == {"exclude": True}
+        assert payload["messages"][0]["role"] == "system"
+        assert payload["messages"][0]["content"][0]["text"] == "SYSTEM"
+        assert payload["messages"][1:] == messages
+
+    def test_reused_prefix_with_new_history(self):
+        _build_payload("SYSTEM", [{"role": "user", "content": "first"}])
+        payload = json.loads(_build_payload("SYSTEM", [{"role": "user", "content": "second"}]))
+        assert "prompt_cache_key" not in payload
+        assert payload["messages"][1:] == [{"role": "user", "content": "second"}]
+
+    def test_empty_history(self):
+        payload = json.loads(_build_payload("SYSTEM", []))
+        assert len(payload["messages"]) == 1
+
+    def test_non_ascii_sent_unescaped(self):
+        payload = _build_payload("SYSTEM", [{"role": "user", "content": "café"}])
+        assert "café".encode("utf-8") in payload
+
+    def test_lone_surrogate_falls_back_to_escapes(self):
+        messages = [{"role": "user", "content": "bad \ud800 text"}]
+        payload = _build_payload("SYSTEM", messages)
+        assert b"\\ud800" in payload
+        assert json.loads(payload)["messages"][1:] == messages
+
+
+class TestPromptCacheKey:
+    def test_depends_on_column_names(self):
+        other = {**SAMPLE_SCHEMA, "columns": [{"name": "\ud800", "type": "VARCHAR"}]}
+        assert _prompt_cache_key(SAMPLE_SCHEMA) != _prompt_cache_key(other)
+
+
+class TestTrimHistory:
+    def test_keeps_everything_within_budget(self):
+        messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+        assert _trim_history(messages, budget=100) == messages
+
+    def test_drops_oldest_messages_over_budget(self):
+        messages = [
+            {"role": "user", "content": "a" * 400},
+            {"role": "assistant", "content": "b" * 40},
+            {"role": "user", "content": "c" * 40},
+        ]
+        assert _trim_history(messages, budget=30) == messages[1:]
+
+    def test_always_keeps_latest_message(self):
+        messages = [{"role": "user", "content": "short"}, {"role": "user", "content": "x" * 1000}]
+        assert _trim_history(messages, budget=10) == messages[1:]
+
+
+class TestResponseKey:
+    def test_ignores_whitespace_in_latest_message(self):
+        key = _schema_key(SAMPLE_SCHEMA)
+        a = _response_key(key, [{"role": "user", "content": "top 10  customers"}])
+        b = _response_key(key, [{"role": "user", "content": " top 10 customers\n"}])
+        assert a == b
+
+    def test_depends_on_history(self):
+        key = _schema_key(SAMPLE_SCHEMA)
+        follow_up = {"role": "user", "content": "break that down by month"}
+        a = _response_key(key, [{"role": "user", "content": "revenue"}, {"role": "assistant", "content": "x"}, follow_up])
+        b = _response_key(key, [{"role": "user", "content": "orders"}, {"role": "assistant", "content": "x"}, follow_up])
+        assert a != b
+
+    def test_lone_surrogate_in_history(self):
+        key = _schema_key(SAMPLE_SCHEMA)
+        assert _response_key(key, [{"role": "user", "content": "\ud800"}]) != _response_key(key, [{"role": "user", "content": "x"}])
+
+    def test_depends_on_schema(self):
+        messages = [{"role": "user", "content": "total"}]
+        other = _schema_key({**SAMPLE_SCHEMA, "tableName": "orders"})
+        assert _response_key(_schema_key(SAMPLE_SCHEMA), messages) != _response_key(other, messages)
+
+
 class TestParseLLMResponse:
     def test_valid_json(self):
         raw = json.dumps({"sql": "SELECT 1", "explanation": "test"})
@@ -62,6 +188,11 @@ class TestParseLLMResponse:
         assert result["sql"] == "SELECT 1"
         assert result["explanation"] == "test"
 
+    def test_markdown_fence_without_newlines(self):
+        raw = '```json {"sql": "SELECT 1", "explanation": "test"}```'
+        result = parse_llm_response(raw)
+        assert result["sql"] == "SELECT 1"
+
     def test_invalid_json_returns_fallback(self):
         result = parse_llm_response("this is not json at all")
         assert result["sql"] == ""
@@ -73,11 +204,36 @@ class TestParseLLMResponse:
         assert result["sql"] == "SELECT 1"
         assert "explanation" in result
 
+    def test_non_string_explanation_gets_default(self):
+        raw = json.dumps({"sql": "SELECT 1", "explanation": 42})
+        result = parse_llm_response(raw)
+        assert result["explanation"] == "No explanation provided."
+
+    def test_extra_keys_dropped(self):
+        raw = json.dumps({"type": "sql", "sql": "SELECT 1", "explanation": "test", "notes": "x"})
+        assert parse_llm_response(raw) == {"sql": "SELECT 1", "explanation": "test"}
+
     def test_extracts_json_block_from_surrounding_text(self):
         raw = 'Here is the result:\n{"sql": "SELECT 1", "explanation": "test"}\nHope this helps!'
         result = parse_llm_response(raw)
         assert result["sql"] == "SELECT 1"
 
+    def test_extracts_deeply_nested_json_block(self):
+        inner = {"sql": "SELECT 1", "explanation": "test", "meta": {"a": {"b": {"c": 1}}}}
+        raw = f"Result:\n{json.dumps(inner)}\nDone."
+        result = parse_llm_response(raw)
+        assert result["sql"] == "SELECT 1"
+
+    def test_extracts_json_block_with_braces_in_strings(self):
+        raw = 'Sure! {"sql": "SELECT \'{\' AS x", "explanation": "a \\"}\\" brace"} trailing }'
+        result = parse_llm_response(raw)
+        assert result["sql"] == "SELECT '{' AS x"
+        assert result["explanation"] == 'a "}" brace'
+
+    def test_skips_unclosed_brace_before_json_block(self):
+        result = parse_llm_response('Use { carefully. {"sql": "SELECT 1", "explanation": "e"}')
+        assert result == {"sql": "SELECT 1", "explanation": "e"}
+
     def test_chart_stripped_from_response(self):
         """LLM may still include chart — parser should strip it."""
         raw = json.dumps({
@@ -125,3 +281,15 @@ class TestParseLLMResponse:
         result = parse_llm_response(raw)
         assert result["sql"] == ""
         assert result["explanation"] == "You're welcome!"
+
+
+class TestSendJson:
+    def test_lone_surrogate_in_response(self):
+        h = handler.__new__(handler)
+        h.wfile = io.BytesIO()
+        h.log_request = lambda *args: None
+        h._send_json(200, {"message": "echo \ud800"})
+        head, _, body = h.wfile.getvalue().partition(b"\r\n\r\n")
+        assert b"200 OK" in head
+        assert f"Content-Length: {len(body)}".encode() in head
+        assert json.loads(body) == {"message": "echo \ud800"}
@@ -0,0 +1,310 @@
+import json
+import logging
+import pytest
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+from api.insights import (
+    build_plan_prompt,
+    build_synthesize_prompt,
+    _cached_plan_prompt,
+    parse_plan_response,
+    parse_insights_response,
+    execute_plot_code,
+    _compile_plot_code,
+    _PlanResultIndex,
+    _InsightScanner,
+    _render_chart,
+    _extract_json_object,
+    _extract_insight_objects,
+    _log_level,
+)
+
+
+SAMPLE_INSIGHT = {
+    "title": "North leads revenue",
+    "priority": "high",
+    "finding": "North has the highest revenue.",
+    "sql": "SELECT region, SUM(revenue) FROM sales GROUP BY region",
+    "pythonCode": "fig = px.bar(df, x='region', y='revenue')",
+    "chartTitle": "Revenue by Region",
+}
+
+
+SAMPLE_SCHEMA = {
+    "tableName": "sales",
+    "rowCount": 2,
+    "columns": [{"name": "region", "type": "VARCHAR"}, {"name": "revenue", "type": "DOUBLE"}],
+    "sampleRows": [{"region": "North", "revenue": 1000}, {"region": "South"}],
+}
+
+
+class TestCachedPlanPrompt:
+    def test_matches_uncached_prompt(self):
+        prompt = _cached_plan_prompt(SAMPLE_SCHEMA)
+        assert prompt == build_plan_prompt(SAMPLE_SCHEMA)
+        assert "| South | NULL |" in prompt
+
+    def test_sample_rows_capped(self):
+        schema = {**SAMPLE_SCHEMA, "sampleRows": [{"region": f"R{i}", "revenue": i} for i in range(15)]}
+        prompt = build_plan_prompt(schema)
+        assert "| R9 | 9 |" in prompt
+        assert "| R10 |" not in prompt
+
+    def test_repeat_schema_reuses_prompt(self):
+        reordered = dict(reversed(list(SAMPLE_SCHEMA.items())))
+        assert _cached_plan_prompt(SAMPLE_SCHEMA) is _cached_plan_prompt(reordered)
+
+
+class TestBuildSynthesizePrompt:
+    def test_rows_deduplicated_and_capped(self):
+        rows = [{"region": "North"}] * 5 + [{"region": f"R{i}"} for i in range(30)]
+        plan = [{"id": "q1", "title": "T", "sql": "SELECT region FROM sales", "result": {"columns": ["region"], "rows": rows}}]
+        prompt = build_synthesize_prompt(SAMPLE_SCHEMA, plan)
+        assert prompt.count("  North\n") == 1
+        assert "  R18\n" in prompt
+        assert "  R19\n" not in prompt
+
+    def test_total_row_text_bounded(self):
+        cols = [f"c{i}" for i in range(20)]
+        rows = [{c: f"{r}" + "v" * 200 for c in cols} for r in range(20)]
+        plan = [
+            {"id": f"q{n}", "title": "T", "sql": "SELECT *", "result": {"columns": cols, "rows": rows}}
+            for n in range(3)
+        ]
+        prompt = build_synthesize_prompt(SAMPLE_SCHEMA, plan)
+        assert "more rows omitted" in prompt
+        assert len(prompt) < 40_000
+
+    def test_wide_result_does_not_starve_later_queries(self):
+        wide_cols = [f"w{i}" for i in range(13)]
+        wide_rows = [{c: f"{r}" + "v" * 200 for c in wide_cols} for r in range(30)]
+        small_cols = [f"s{i}" for i in range(12)]
+        small_rows = [{c: f"s{r}" + "v" * 200 for c in small_cols} for r in range(2)]
+        plan = [
+            {"id": "q1", "title": "Wide", "sql": "SELECT *", "result": {"columns": wide_cols, "rows": wide_rows}},
+            {"id": "q2", "title": "Small", "sql": "SELECT *", "result": {"columns": small_cols, "rows": small_rows}},
+        ]
+        prompt = build_synthesize_prompt(SAMPLE_SCHEMA, plan)
+        wide, small = prompt.split("### Small")
+        assert "more rows omitted" in wide
+        assert "  s0" in small and "  s1" in small
+        assert "more rows omitted" not in small
+
+    def test_long_values_truncated(self):
+        plan = [{"id": "q1", "title": "T", "sql": "SELECT note FROM sales", "result": {"columns": ["note"], "rows": [{"note": "x" * 1000}]}}]
+        prompt = build_synthesize_prompt(SAMPLE_SCHEMA, plan)
+        assert "x" * 127 + "…" in prompt
+        assert "x" * 128 not in prompt
+
+
+class TestExtractJsonObject:
+    def test_object_in_surrounding_text(self):
+        text = 'Here you go: {"a": {"b": [1, 2]}} thanks'
+        assert _extract_json_object(text) == {"a": {"b": [1, 2]}}
+
+    def test_braces_inside_strings(self):
+        text = 'x {"sql": "SELECT \'}\' AS c", "note": "say \\"{hi}\\""} y'
+        assert _extract_json_object(text) == {"sql": "SELECT '}' AS c", "note": 'say "{hi}"'}
+
+    def test_unclosed_object_returns_none(self):
+        assert _extract_json_object('{"a": {"b": 1}') is None
+
+    def test_unterminated_string_returns_none(self):
+        assert _extract_json_object('{"a": "never } closed') is None
+
+    def test_invalid_candidate_skipped(self):
+        assert _extract_json_object("{not json} then {\"a\": 1}") == {"a": 1}
+
+    def test_no_object_returns_none(self):
+        assert _extract_json_object("no json here") is None
+
+
+class TestExtractInsightObjects:
+    def test_salvages_complete_items_from_truncated_array(self):
+        text = '{"summary": "s", "insights": [' + json.dumps(SAMPLE_INSIGHT) + ', {"title": "cut off'
+        objects = _extract_insight_objects(text)
+        assert objects == [SAMPLE_INSIGHT]
+
+    def test_malformed_item_skipped(self):
+        text = '{"insights": [{"title": bad}, ' + json.dumps(SAMPLE_INSIGHT) + "]}"
+        assert _extract_insight_objects(text) == [SAMPLE_INSIGHT]
+
+    def test_missing_array_returns_empty(self):
+        assert _extract_insight_objects('{"summary": "s"}') == []
+
+
+class TestInsightScanner:
+    def test_items_reported_once_as_they_complete(self):
+        other = {**SAMPLE_INSIGHT, "title": "South lags"}
+        text = '{"summary": "s", "insights": [' + json.dumps(SAMPLE_INSIGHT) + ", " + json.dumps(other) + "]}"
+        scanner = _InsightScanner()
+        seen = []
+        for end in range(1, len(text) + 1):
+            seen.extend(scanner.feed(text[:end]))
+        assert [(idx, item["title"]) for idx, item in seen] == [(0, "North leads revenue"), (1, "South lags")]
+        assert seen[0][1] == parse_insights_response(text)["insights"][0]
+
+    def test_invalid_items_not_numbered(self):
+        text = '{"insights": [{"title": "no finding"}, ' + json.dumps(SAMPLE_INSIGHT) + "]}"
+        assert [idx for idx, _ in _InsightScanner().feed(text)] == [0]
+
+    def test_nothing_before_array(self):
+        assert _InsightScanner().feed('{"summary": "still writing') == []
+
+
+class TestPlanResultIndex:
+    REGION = {"columns": ["region"], "rows": [{"region": "North"}]}
+    MONTH = {"columns": ["month"], "rows": [{"month": "Jan"}]}
+    PLAN = [
+        {"id": "q1", "sql": "SELECT region, SUM(revenue) FROM sales GROUP BY region ORDER BY 2 DESC LIMIT 20", "result": REGION},
+        {"id": "q2", "sql": "SELECT month, COUNT(*) FROM sales GROUP BY month LIMIT 20", "result": MONTH},
+        {"id": "q3", "sql": "SELECT bad", "error": "syntax error"},
+    ]
+
+    def test_exact_match_ignores_case_and_whitespace(self):
+        index = _PlanResultIndex(self.PLAN)
+        sql = "select month,  count(*)\nfrom sales group by month limit 20"
+        assert index.find(sql, 0) is self.MONTH
+
+    def test_fragment_of_plan_sql_matches(self):
+        index = _PlanResultIndex(self.PLAN)
+        assert index.find("SELECT month, COUNT(*) FROM sales GROUP BY month", 0) is self.MONTH
+
+    def test_plan_sql_inside_insight_sql_matches(self):
+        index = _PlanResultIndex(self.PLAN)
+        sql = "SELECT region, SUM(revenue) FROM sales GROUP BY region ORDER BY 2 DESC LIMIT 20;"
+        assert index.find(sql, 1) is self.REGION
+
+    def test_boilerplate_fragment_falls_back_to_position(self):
+        index = _PlanResultIndex(self.PLAN)
+        assert index.find("FROM sales GROUP BY", 1) is self.MONTH
+
+    def test_short_fragment(self):
+        index = _PlanResultIndex(self.PLAN)
+        assert index.find("SELECT month", 0) is self.MONTH
+        assert index.find("LIMIT 20", 0) is self.REGION
+
+    def test_empty_sql_falls_back_to_position(self):
+        index = _PlanResultIndex(self.PLAN)
+        assert index.find("", 1) is self.MONTH
+        assert index.find(None, 0) is self.REGION
+
+    def test_unrelated_sql_falls_back_to_position(self):
+        index = _PlanResultIndex(self.PLAN)
+        assert index.find("SELECT AVG(x) FROM other_table", 1) is self.MONTH
+
+    def test_no_match_past_plan_length(self):
+        index = _PlanResultIndex(self.PLAN)
+        assert index.find("SELECT AVG(x) FROM other_table", 5) is None
+
+
+class TestParsePlanResponse:
+    def test_valid_plan(self):
+        raw = json.dumps({"queries": [{"id": "q1", "title": "T", "sql": "SELECT 1", "rationale": "r"}]})
+        result = parse_plan_response(raw)
+        assert result == {"queries": [{"id": "q1", "title": "T", "sql": "SELECT 1", "rationale": "r"}]}
+
+    def test_markdown_wrapped(self):
+        inner = json.dumps({"queries": [{"title": "T", "sql": "SELECT 1"}]})
+        result = parse_plan_response(f"```json\n{inner}\n```")
+        assert result["queries"][0]["sql"] == "SELECT 1"
+        assert result["queries"][0]["id"] == "q1"
+
+    def test_numeric_id_stringified(self):
+        raw = json.dumps({"queries": [{"id": 3, "title": "T", "sql": "SELECT 1"}]})
+        assert parse_plan_response(raw)["queries"][0]["id"] == "3"
+
+    def test_alternate_list_key(self):
+        raw = json.dumps({"analysis": [{"title": "T", "sql": "SELECT 1"}]})
+        assert len(parse_plan_response(raw)["queries"]) == 1
+
+    def test_bare_array(self):
+        raw = json.dumps([{"title": "T", "sql": "SELECT 1"}])
+        assert len(parse_plan_response(raw)["queries"]) == 1
+
+    def test_invalid_items_dropped(self):
+        raw = json.dumps({"queries": [{"title": "T"}, {"title": "U", "sql": "SELECT 2"}]})
+        result = parse_plan_response(raw)
+        assert [q["sql"] for q in result["queries"]] == ["SELECT 2"]
+
+    def test_invalid_json_returns_fallback(self):
+        assert parse_plan_response("not json") == {"queries": []}
+
+
+class TestParseInsightsResponse:
+    def test_valid_response(self):
+        raw = json.dumps({"summary": "Summary.", "insights": [SAMPLE_INSIGHT]})
+        result = parse_insights_response(raw)
+        assert result["summary"] == "Summary."
+        assert result["insights"][0]["pythonCode"] == SAMPLE_INSIGHT["pythonCode"]
+        assert result["insights"][0]["chartTitle"] == "Revenue by Region"
+
+    def test_markdown_wrapped(self):
+        inner = json.dumps({"summary": "Fenced.", "insights": [SAMPLE_INSIGHT]})
+        result = parse_insights_response(f"```json\n{inner}\n```")
+        assert result["summary"] == "Fenced."
+        assert len(result["insights"]) == 1
+
+    def test_truncated_response_salvaged(self):
+        raw = '{"summary": "Partial.", "insights": [' + json.dumps(SAMPLE_INSIGHT) + ', {"title": "x", "fin'
+        result = parse_insights_response(raw)
+        assert result["summary"] == "Partial."
+        assert len(result["insights"]) == 1
+
+    def test_invalid_priority_defaults_to_medium(self):
+        raw = json.dumps({"summary": "s", "insights": [{**SAMPLE_INSIGHT, "priority": "urgent"}]})
+        assert parse_insights_response(raw)["insights"][0]["priority"] == "medium"
+
+    def test_null_python_code_omitted(self):
+        raw = json.dumps({"summary": "s", "insights": [{**SAMPLE_INSIGHT, "pythonCode": None}]})
+        insight = parse_insights_response(raw)["insights"][0]
+        assert "pythonCode" not in insight
+        assert "chartTitle" not in insight
+
+    def test_missing_summary_gets_default(self):
+        raw = json.dumps({"insights": []})
+        assert parse_insights_response(raw)["summary"] == "Analysis complete."
+
+    def test_garbage_returns_empty_insights(self):
+        result = parse_insights_response("nothing useful")
+        assert result["insights"] == []
+
+
+class TestExecutePlotCode:
+    ROWS = [{"region": "North", "revenue": 1000}, {"region": "South", "revenue": 800}]
+
+    def test_simple_bar_chart(self):
+        result = execute_plot_code("fig = px.bar(df, x='region', y='revenue')", pd.DataFrame(self.ROWS))
+        assert "data" in result
+        assert "layout" in result
+
+    def test_result_is_json_encodable(self):
+        rows = [{"region": "North", "revenue": 1.5}, {"region": "South", "revenue": None}]
+        result = execute_plot_code("fig = px.bar(df, x='region', y='revenue')", pd.DataFrame(rows))
+        encoded = json.loads(json.dumps(result, cls=PlotlyJSONEncoder))
+        assert encoded["data"][0]["type"] == "bar"
+        assert "uid" not in encoded["data"][0]
+
+    def test_repeat_code_reuses_compiled_object(self):
+        code = "fig = px.line(df, x='region', y='revenue')"
+        assert _compile_plot_code(code) is _compile_plot_code(code)
+        assert "data" in execute_plot_code(code, pd.DataFrame(self.ROWS))
+
+    def test_render_chart_uses_result_columns(self):
+        result = {"columns": ["region", "revenue"], "rows": [{"revenue": 1000, "region": "North"}, {"region": "South"}]}
+        spec = _render_chart("fig = px.bar(df, x=df.columns[0], y=df.columns[1])", result)
+        assert spec["layout"]["xaxis"]["title"]["text"] == "region"
+
+    def test_multi_statement_code(self):
+        code = "top = df.sort_values('revenue')\nfig = px.bar(top, x='region', y='revenue')\nfig.update_layout(title='T')"
+        assert execute_plot_code(code, pd.DataFrame(self.ROWS))["layout"]["title"]["text"] == "T"
+
+
+class TestLogLevel:
+    def test_known_names_case_insensitive(self):
+        assert _log_level("debug") == logging.DEBUG
+        assert _log_level("WARNING") == logging.WARNING
+
+    def test_unknown_name_falls_back_to_info(self):
+        assert _log_level("verbose") == logging.INFO
+
@@ -0,0 +1,143 @@
+import gzip
+import json
+import urllib.error
+import api._openrouter as _openrouter
+from api._openrouter import (
+    LRUCache,
+    dumps,
+    find_json_object,
+    prompt_value,
+    strip_code_fence,
+)
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+
+class TestDumps:
+    def test_compact_and_unescaped(self):
+        assert dumps({"a": [1, "é"]}) == '{"a":[1,"é"]}'.encode("utf-8")
+
+    def test_lone_surrogate_falls_back_to_escapes(self):
+        encoded = dumps({"sql": "\udfff"})
+        assert b"\\udfff" in encoded
+        assert json.loads(encoded) == {"sql": "\udfff"}
+
+
+class TestFindJsonObject:
+    def test_object_in_surrounding_text(self):
+        assert find_json_object('Sure: {"a": {"b": 1}} done') == '{"a": {"b": 1}}'
+
+    def test_braces_inside_strings(self):
+        text = 'x {"a": "}{", "b": "\\"}"} y'
+        assert json.loads(find_json_object(text)) == {"a": "}{", "b": '"}'}
+
+    def test_skips_unclosed_brace(self):
+        assert find_json_object('Use { carefully. {"sql": "SELECT 1"}') == '{"sql": "SELECT 1"}'
+
+    def test_no_balanced_object(self):
+        assert find_json_object('{"a": 1') is None
+        assert find_json_object("no braces") is None
+
+
+class TestStripCodeFence:
+    def test_language_fence(self):
+        assert strip_code_fence('```json\n{"a": 1}\n```') == '{"a": 1}'
+
+    def test_closing_fence_on_last_line(self):
+        assert strip_code_fence('```json\n{"a": 1}```') == '{"a": 1}'
+
+    def test_unfenced_text_unchanged(self):
+        assert strip_code_fence('{"a": 1}') == '{"a": 1}'
+
+
+class TestPromptValue:
+    def test_long_values_truncated(self):
+        assert prompt_value("x" * 1000) == "x" * 127 + "…"
+        assert prompt_value(42) == "42"
+
+
+class _FakeResponse:
+    def __init__(self, status, body):
+        self.status = status
+        self.reason = "Error" if status >= 400 else "OK"
+        self.headers = {}
+        self.will_close = True
+        self._body = body
+
+    def read(self):
+        body, self._body = self._body, b""
+        return body
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class TestGzipRequestFallback:
+    PAYLOAD = b'{"messages": "' + b"x" * 4096 + b'"}'
+
+    def _post(self, monkeypatch, *responses, consume=None, enabled=True):
+        sent = []
+        queued = list(responses)
+
+        class FakeConnection:
+            def __init__(self, host, timeout=None):
+                self.sock = None
+
+            def request(self, method, path, body=None, headers=None):
+                sent.append((headers.get("Content-Encoding"), body))
+
+            def getresponse(self):
+                return _FakeResponse(*queued.pop(0))
+
+            def close(self):
+                pass
+
+        monkeypatch.setattr(_openrouter.http.client, "HTTPSConnection", FakeConnection)
+        monkeypatch.setattr(_openrouter, "_pool", [])
+        monkeypatch.setattr(_openrouter, "_gzip_request_bodies", enabled)
+        try:
+            return _openrouter.post_openrouter(self.PAYLOAD, {}, 5, consume), sent
+        except urllib.error.HTTPError as e:
+            return e, sent
+
+    def test_off_unless_enabled(self, monkeypatch):
+        result, sent = self._post(monkeypatch, (200, b"ok"), enabled=False)
+        assert result == b"ok"
+        assert sent == [(None, self.PAYLOAD)]
+
+    def test_compressed_stream_success(self, monkeypatch):
+        result, sent = self._post(monkeypatch, (200, b"data: x\n"), consume=lambda resp: ("text", "stop"))
+        assert result == ("text", "stop")
+        assert len(sent) == 1 and sent[0][0] == "gzip"
+        assert _openrouter._gzip_request_bodies is True
+
+    def test_unsupported_media_type_retries_uncompressed(self, monkeypatch):
+        result, sent = self._post(monkeypatch, (415, b""), (200, b"ok"))
+        assert result == b"ok"
+        assert sent[0][0] == "gzip" and gzip.decompress(sent[0][1]) == self.PAYLOAD
+        assert sent[1] == (None, self.PAYLOAD)
+        assert _openrouter._gzip_request_bodies is False
+
+    def test_generic_bad_request_retries_uncompressed(self, monkeypatch):
+        result, sent = self._post(monkeypatch, (400, b"Bad Request"), (200, b"ok"))
+        assert result == b"ok"
+        assert len(sent) == 2
+        assert _openrouter._gzip_request_bodies is False
+
+    def test_bad_request_either_way_keeps_compression(self, monkeypatch):
+        invalid = b'{"error": "invalid model"}'
+        error, sent = self._post(monkeypatch, (400, invalid), (400, invalid))
+        assert isinstance(error, urllib.error.HTTPError) and error.code == 400
+        assert error.read() == invalid
+        assert [encoding for encoding, _ in sent] == ["gzip", None]
+        assert _openrouter._gzip_request_bodies is True
@@ -0,0 +1,98 @@
+import json
+import pytest
+import pandas as pd
+from api._plot_sandbox import compile_plot_code, encode_response, run_plot
+
+
+ROWS = [{"region": "North", "revenue": 1000}, {"region": "South", "revenue": 800}]
+
+
+def _run(code):
+    return run_plot(compile_plot_code(code), pd.DataFrame(ROWS))
+
+
+class TestPlotSandbox:
+    def test_simple_bar_chart(self):
+        result = _run("fig = px.bar(df, x='region', y='revenue')")
+        assert result["data"][0]["type"] == "bar"
+        assert "uid" not in result["data"][0]
+
+    def test_missing_fig_raises(self):
+        with pytest.raises(ValueError, match="fig"):
+            _run("x = 1")
+
+    def test_restricted_builtins(self):
+        with pytest.raises(Exception):
+            _run("open('/etc/passwd')")
+
+    def test_imports_rejected(self):
+        with pytest.raises(ValueError, match="imports"):
+            _run("import os\nfig = px.bar(df)")
+
+    def test_dunder_attribute_rejected(self):
+        with pytest.raises(ValueError, match="__class__"):
+            _run("fig = df.__class__")
+
+    def test_file_io_rejected(self):
+        with pytest.raises(ValueError, match="read_csv"):
+            _run("fig = pd.read_csv('/etc/passwd')")
+
+    def test_fig_on_untaken_branch_raises(self):
+        with pytest.raises(ValueError, match="fig"):
+            _run("if df.shape[0] > 10:\n    fig = px.bar(df)")
+
+    def test_non_figure_result_raises(self):
+        with pytest.raises(ValueError, match="Figure"):
+            _run("fig = df")
+
+    @pytest.mark.parametrize("code, blocked", [
+        ("df.to_json('/tmp/x')", "to_json"),
+        ("df.to_html('/tmp/x')", "to_html"),
+        ("df.to_string(buf='/tmp/x')", "to_string"),
+        ("df.to_markdown('/tmp/x')", "to_markdown"),
+        ("df.to_latex('/tmp/x')", "to_latex"),
+        ("df.to_xml('/tmp/x')", "to_xml"),
+        ("df.to_clipboard()", "to_clipboard"),
+        ("df.to_csv('/tmp/x')", "to_csv"),
+        ("df.to_pickle('/tmp/x')", "to_pickle"),
+        ("df.style.to_html('/tmp/x')", "to_html"),
+        ("df.to_numpy().tofile('/tmp/x')", "tofile"),
+        ("df.values.dump('/tmp/x')", "dump"),
+        ("df.eval('revenue * 2')", "eval"),
+        ("df.query('revenue > 1')", "query"),
+        ("pd.eval('1 + 1')", "pd.eval"),
+        ("pd.compat.pickle_compat", "pd.compat"),
+        ("pd.io.parsers", "pd.io"),
+        ("px.np.zeros(3)", "px.np"),
+        ("px.defaults.template = 'x'", "px.defaults"),
+        ("m = pd\nm.compat", "'pd' may only be used"),
+        ("f = lambda m: m\nf(pd)", "'pd' may only be used"),
+        ("go.Figure().write_html('/tmp/x')", "write_html"),
+    ])
+    def test_blocked_methods_rejected(self, code, blocked):
+        with pytest.raises(ValueError, match=blocked):
+            _run(code + "\nfig = px.bar(df)")
+
+    def test_allowed_transforms_run(self):
+        code = (
+            "df['month'] = pd.to_datetime('2024-01-01')\n"
+            "top = df.groupby('region', as_index=False)['revenue'].sum().to_dict('records')\n"
+            "fig = go.Figure(go.Bar(x=[r['region'] for r in top], y=[r['revenue'] for r in top]))"
+        )
+        assert _run(code)["data"][0]["type"] == "bar"
+
+
+class TestEncodeResponse:
+    def test_figure_dict_with_missing_values(self):
+        rows = [{"region": "North", "revenue": 1.5}, {"region": "South", "revenue": None}]
+        spec = run_plot(compile_plot_code("fig = px.bar(df, x='region', y='revenue')"), pd.DataFrame(rows))
+        decoded = json.loads(encode_response({"insights": [{"title": "é", "plotlySpec": spec}]}))
+        assert decoded["insights"][0]["title"] == "é"
+        assert decoded["insights"][0]["plotlySpec"]["data"][0]["type"] == "bar"
+
+    def test_nan_encoded_as_null(self):
+        assert json.loads(encode_response({"v": [1.0, float("nan")]})) == {"v": [1.0, None]}
+
+    def test_lone_surrogate_falls_back_to_escapes(self):
+        data = {"error": "bad \ud800", "v": [1.0, float("nan")]}
+        assert json.loads(encode_response(data)) == {"error": "bad \ud800", "v": [1.0, None]}
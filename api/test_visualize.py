@@ -1,7 +1,25 @@
+import gzip
+import io
 import json
+import threading
+import urllib.error
 import pytest
 import pandas as pd
-from api.visualize import build_visualize_prompt, parse_visualize_response, execute_plot_code
+import plotly.express as px
+import api.visualize as visualize
+from api.visualize import (
+    call_openrouter,
+    handler,
+    VISUALIZE_SYSTEM_PROMPT,
+    build_visualize_prompt,
+    parse_visualize_response,
+    execute_plot_code,
+    _compile_plot_code,
+    _accepts_gzip,
+    _no_chart_needed,
+    _parse_cached,
+)
+from api._plot_sandbox import encode_response
 
 
 SAMPLE_COLUMNS = ["region", "revenue", "cost"]
@@ -14,39 +32,73 @@ SAMPLE_ROWS = [
 
 class TestBuildVisualizePrompt:
     def test_contains_question(self):
-        prompt = build_visualize_prompt("show revenue by region", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
-        assert "show revenue by region" in prompt
+        _, user = build_visualize_prompt("show revenue by region", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
+        assert "show revenue by region" in user
 
     def test_contains_sql(self):
-        prompt = build_visualize_prompt("q", "SELECT region, revenue FROM t", SAMPLE_COLUMNS, SAMPLE_ROWS)
-        assert "SELECT region, revenue FROM t" in prompt
+        _, user = build_visualize_prompt("q", "SELECT region, revenue FROM t", SAMPLE_COLUMNS, SAMPLE_ROWS)
+        assert "SELECT region, revenue FROM t" in user
 
     def test_contains_columns(self):
-        prompt = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
-        assert "region" in prompt
-        assert "revenue" in prompt
-        assert "cost" in prompt
+        _, user = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
+        assert "region" in user
+        assert "revenue" in user
+        assert "cost" in user
 
     def test_contains_row_data(self):
-        prompt = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
-        assert "North" in prompt
-        assert "1000" in prompt
+        _, user = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
+        assert "North" in user
+        assert "1000" in user
 
     def test_caps_rows_at_50(self):
         many_rows = [{"region": f"r{i}", "revenue": i, "cost": i} for i in range(100)]
-        prompt = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, many_rows)
-        assert "100 total rows, showing up to 50" in prompt
-        assert "r50" not in prompt
+        _, user = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, many_rows)
+        assert "100 total rows, showing up to 50" in user
+        assert "r50" not in user
+
+    def test_truncates_long_values(self):
+        rows = [{"region": "x" * 500, "revenue": 1, "cost": 1}]
+        _, user = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, rows)
+        assert "x" * 500 not in user
+        assert "x" * 127 + "…" in user
+
+    def test_wide_rows_stop_at_budget(self):
+        rows = [{"region": f"r{i}", "revenue": "y" * 120, "cost": "z" * 120} for i in range(50)]
+        _, user = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, rows)
+        assert "r0 |" in user
+        assert "r49 |" not in user
+        assert "more rows omitted)" in user
 
     def test_contains_plotly_scope_doc(self):
-        prompt = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
-        assert "pandas" in prompt
-        assert "plotly" in prompt
-        assert "fig" in prompt
+        system, _ = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
+        assert "pandas" in system
+        assert "plotly" in system
+        assert "fig" in system
 
     def test_asks_for_python_code(self):
-        prompt = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
-        assert "pythonCode" in prompt
+        system, _ = build_visualize_prompt("q", "SELECT ...", SAMPLE_COLUMNS, SAMPLE_ROWS)
+        assert "pythonCode" in system
+
+    def test_system_prompt_is_request_independent(self):
+        system_a, user_a = build_visualize_prompt("q1", "SELECT 1", SAMPLE_COLUMNS, SAMPLE_ROWS)
+        system_b, user_b = build_visualize_prompt("q2", "SELECT 2", ["x"], [{"x": 1}])
+        assert system_a is system_b is VISUALIZE_SYSTEM_PROMPT
+        assert user_a != user_b
+
+
+class TestNoChartNeeded:
+    def test_scalar_result(self):
+        assert _no_chart_needed(["total"], [{"total": 42}])
+
+    def test_distinct_text_column(self):
+        assert _no_chart_needed(["name"], [{"name": "a"}, {"name": "b"}, {"name": "c"}])
+
+    def test_repeated_text_column_still_asks(self):
+        assert not _no_chart_needed(["name"], [{"name": "a"}, {"name": "a"}, {"name": "b"}])
+
+    def test_numeric_or_multi_column_results_still_ask(self):
+        assert not _no_chart_needed(["revenue"], [{"revenue": 1}, {"revenue": 2}])
+        assert not _no_chart_needed(SAMPLE_COLUMNS, SAMPLE_ROWS[:1])
 
 
 class TestParseVisualizeResponse:
@@ -90,6 +142,29 @@ class TestParseVisualizeResponse:
         assert result["pythonCode"] is not None
         assert "px.line" in result["pythonCode"]
 
+    def test_unlabelled_fence_on_one_line(self):
+        inner = json.dumps({
+            "pythonCode": "fig = px.bar(df, x='region', y='revenue')",
+            "chartTitle": "T",
+        })
+        result = parse_visualize_response(f"```{inner}```")
+        assert result["pythonCode"] is not None
+
+    def test_extracts_json_from_surrounding_text(self):
+        inner = json.dumps({"pythonCode": "fig = px.bar(df)", "chartTitle": "T"})
+        result = parse_visualize_response(f"Here is the chart: {inner} Hope it helps!")
+        assert result["pythonCode"] == "fig = px.bar(df)"
+
+    def test_braces_inside_code_string(self):
+        code = "fig = px.bar(df, labels={'revenue': 'Rev {USD}'})\nfig.update_layout(title='}')"
+        inner = json.dumps({"pythonCode": code, "chartTitle": "T"})
+        result = parse_visualize_response(f"Sure! {inner}")
+        assert result["pythonCode"] == code
+
+    def test_skips_unclosed_brace_before_json_block(self):
+        raw = 'Group by { region. {"pythonCode": "fig = px.bar(df)", "chartTitle": "T"}'
+        assert parse_visualize_response(raw) == {"pythonCode": "fig = px.bar(df)", "chartTitle": "T"}
+
     def test_invalid_json_returns_null(self):
         result = parse_visualize_response("this is not json")
         assert result["pythonCode"] is None
@@ -115,6 +190,18 @@ class TestParseVisualizeResponse:
         assert result["chartTitle"] == "Chart"
 
 
+class TestParseCached:
+    def test_matches_uncached_parse(self):
+        raw = json.dumps({"pythonCode": "fig = px.bar(df)", "chartTitle": "T"})
+        assert _parse_cached(raw) == parse_visualize_response(raw)
+
+    def test_returns_fresh_copy(self):
+        raw = json.dumps({"pythonCode": "fig = px.bar(df)", "chartTitle": "T"})
+        first = _parse_cached(raw)
+        first["chartTitle"] = "mutated"
+        assert _parse_cached(raw)["chartTitle"] == "T"
+
+
 class TestExecutePlotCode:
     def test_simple_bar_chart(self):
         df = pd.DataFrame(SAMPLE_ROWS)
@@ -123,6 +210,16 @@ class TestExecutePlotCode:
         assert "data" in result
         assert "layout" in result
 
+    def test_result_is_json_encodable(self):
+        df = pd.DataFrame(SAMPLE_ROWS)
+        code = "fig = px.bar(df, x='region', y='revenue')"
+        encoded = json.loads(encode_response({"plotlySpec": execute_plot_code(code, df)}))
+        trace = encoded["plotlySpec"]["data"][0]
+        assert trace["type"] == "bar"
+        assert "uid" not in trace
+        # Same wire format as fig.to_json(), e.g. typed-array encoding
+        assert trace["y"] == json.loads(px.bar(df, x="region", y="revenue").to_json())["data"][0]["y"]
+
     def test_pivot_heatmap(self):
         rows = [
             {"region": "North", "category": "A", "value": 10},
@@ -140,8 +237,116 @@ fig = px.imshow(pivot, text_auto=True)"""
         with pytest.raises(ValueError, match="fig"):
             execute_plot_code(code, df)
 
+    def test_repeat_run_gets_fresh_scope(self):
+        df = pd.DataFrame(SAMPLE_ROWS)
+        code = "fig = px.bar(df, x='region', y='revenue')"
+        first = execute_plot_code(code, df)
+        second = execute_plot_code(code, df.head(1))
+        assert len(first["data"][0]["x"]) == 3
+        assert len(second["data"][0]["x"]) == 1
+
     def test_restricted_builtins(self):
         df = pd.DataFrame(SAMPLE_ROWS)
         code = "open('/etc/passwd')"
         with pytest.raises(Exception):
             execute_plot_code(code, df)
+
+    def test_repeat_code_reuses_compiled_function(self):
+        code = "fig = px.line(df, x='region', y='revenue')"
+        assert _compile_plot_code(code) is _compile_plot_code(code)
+
+
+class TestCallOpenrouterCoalescing:
+    def test_waiters_each_see_the_error_body(self, monkeypatch):
+        waiting = threading.Event()
+        calls = []
+
+        class TrackingDict(dict):
+            def get(self, key, default=None):
+                pending = super().get(key, default)
+                if pending is not None:
+                    waiting.set()
+                return pending
+
+        def failing_post(payload, headers, timeout):
+            calls.append(payload)
+            waiting.wait(5)
+            raise urllib.error.HTTPError("u", 429, "Too Many Requests", {}, io.BytesIO(b"rate limited"))
+
+        monkeypatch.setenv("OPENROUTER_API_KEY", "k")
+        monkeypatch.setattr(visualize, "_inflight", TrackingDict())
+        monkeypatch.setattr(visualize, "post_openrouter", failing_post)
+
+        bodies = []
+
+        def call():
+            try:
+                call_openrouter("sys", "coalesced failure")
+            except urllib.error.HTTPError as e:
+                bodies.append((e.code, e.read()))
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        threads[0].start()
+        while not calls:
+            threads[0].join(0.01)
+        threads[1].start()
+        for t in threads:
+            t.join(5)
+        assert len(calls) == 1
+        assert bodies == [(429, b"rate limited")] * 2
+
+
+class TestAcceptsGzip:
+    @pytest.mark.parametrize("header, expected", [
+        ("gzip, deflate, br", True),
+        ("GZIP", True),
+        ("gzip;q=0.5", True),
+        ("*", True),
+        ("", False),
+        ("br", False),
+        ("gzip;q=0", False),
+        ("gzip; q=0.0, br", False),
+        ("*;q=0", False),
+        ("gzip;q=0, *", False),
+        ("br, *;q=0.1", True),
+    ])
+    def test_header(self, header, expected):
+        assert _accepts_gzip(header) is expected
+
+
+class TestSendJson:
+    def _send(self, accept_encoding, data):
+        h = handler.__new__(handler)
+        h.headers = {"Accept-Encoding": accept_encoding}
+        h.wfile = io.BytesIO()
+        h.request_version = "HTTP/1.1"
+        h.requestline = "POST /api/visualize HTTP/1.1"
+        h.client_address = ("test", 0)
+        h.log_request = lambda *args: None
+        h._send_json(200, data)
+        head, _, body = h.wfile.getvalue().partition(b"\r\n\r\n")
+        return head.decode("latin-1"), body
+
+    def test_large_body_gzipped_when_accepted(self):
+        data = {"plotlySpec": {"data": [{"x": list(range(500))}]}}
+        head, body = self._send("gzip, br", data)
+        assert "Content-Encoding: gzip" in head
+        assert f"Content-Length: {len(body)}" in head
+        assert json.loads(gzip.decompress(body)) == data
+
+    def test_gzip_refused_with_q0(self):
+        data = {"plotlySpec": {"data": [{"x": list(range(500))}]}}
+        head, body = self._send("gzip;q=0, br", data)
+        assert "Content-Encoding" not in head
+        assert json.loads(body) == data
+
+    def test_lone_surrogate_in_response(self):
+        head, body = self._send("gzip", {"error": "bad \ud800"})
+        assert "200 OK" in head
+        assert json.loads(body) == {"error": "bad \ud800"}
+
+    def test_small_body_sent_uncompressed(self):
+        head, body = self._send("gzip", {"error": "x"})
+        assert "Content-Encoding" not in head
+        assert "Vary: Accept-Encoding" in head
+        assert json.loads(body) == {"error": "x"}
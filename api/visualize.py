@@ -1,14 +1,51 @@
+from concurrent.futures import Future
 from http.server import BaseHTTPRequestHandler
+import gzip
+import hashlib
+import io
 import json
 import os
 import sys
+import threading
 import traceback
-import urllib.request
+import urllib.error
 
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 
+from api._openrouter import (
+    LRUCache,
+    dumps,
+    find_json_object,
+    loads,
+    post_openrouter,
+    prompt_value,
+    strip_code_fence,
+)
+from api._plot_sandbox import compile_plot_code, encode_response, run_plot
+
+# Response bodies at least this large are gzip-compressed for clients that accept it
+GZIP_MIN_BYTES = 1024
+
+# Result rows shown to the model
+PROMPT_MAX_ROWS = 50
+# Total characters of the row table, so wide results do not crowd the context
+PROMPT_ROWS_BUDGET = 12_000
+
+COMPLETION_CACHE_SIZE = 512
+PARSE_CACHE_SIZE = 1024
+CODE_CACHE_SIZE = 256
+
+
+# Completion text keyed by sha256 of the request payload
+_completion_cache = LRUCache(COMPLETION_CACHE_SIZE)
+# Completions currently being fetched, keyed like _completion_cache, so
+# identical concurrent requests share one upstream call
+_inflight: dict[bytes, Future] = {}
+_inflight_lock = threading.Lock()
+# parse_visualize_response results keyed by the raw LLM content string
+_parse_cache = LRUCache(PARSE_CACHE_SIZE)
+# Validated plot functions keyed by source
+_code_cache = LRUCache(CODE_CACHE_SIZE)
 
 PLOTLY_SCOPE_DOC = """AVAILABLE SCOPE (these variables are already defined — do NOT import anything):
 - df: a pandas DataFrame containing the query result rows
@@ -22,40 +59,25 @@ Use px.imshow for heatmaps/matrices, px.bar for bar charts, px.line for line cha
 Do NOT set template, font colors, paper_bgcolor, or plot_bgcolor — the frontend handles all theming."""
 
 
-def build_visualize_prompt(question: str, sql: str, columns: list, rows: list) -> str:
-    capped_rows = rows[:50]
-    header = " | ".join(columns)
-    row_lines = []
-    for row in capped_rows:
-        vals = " | ".join(str(row.get(c, "NULL")) for c in columns)
-        row_lines.append(f"| {vals} |")
-    rows_text = "\n".join(row_lines)
+# The system message is the same for every request so OpenRouter can reuse
+# its cached prefix; everything request-specific goes in the user message.
+VISUALIZE_SYSTEM_PROMPT = """You are a data visualization expert. Given query results, decide if a chart is appropriate and write Python code using pandas and plotly to render it.
 
-    return f"""You are a data visualization expert. Given query results, decide if a chart is appropriate and write Python code using pandas and plotly to render it.
-
-USER QUESTION: {question}
-SQL QUERY: {sql}
-
-QUERY RESULTS ({len(rows)} total rows, showing up to 50):
-Columns: {', '.join(columns)}
-| {header} |
-{rows_text}
-
-{PLOTLY_SCOPE_DOC}
+""" + PLOTLY_SCOPE_DOC + """
 
 If the data is suitable for visualization, return a JSON object with "pythonCode" containing Python code that creates a `fig` variable.
-If not (e.g., single scalar value, too many categories, or text-heavy results), return {{"pythonCode": null}}.
+If not (e.g., single scalar value, too many categories, or text-heavy results), return {"pythonCode": null}.
 
 Return ONLY valid JSON (no markdown fences) with this structure:
-{{"pythonCode": "pivot = df.pivot_table(...)\\nfig = px.bar(...)", "chartTitle": "Chart title"}}
+{"pythonCode": "pivot = df.pivot_table(...)\\nfig = px.bar(...)", "chartTitle": "Chart title"}
 
 Or if no chart is appropriate:
-{{"pythonCode": null}}
+{"pythonCode": null}
 
 RULES:
 1. The code must assign a plotly Figure to a variable called `fig`
 2. Use `df` directly — it is a pandas DataFrame with the query result rows
-3. Column names must exactly match: {', '.join(columns)}
+3. Column names must exactly match the Columns line of the query results
 4. You can freely transform df (pivot_table, melt, groupby, etc.) before charting
 5. For matrix/heatmap visualizations, use px.imshow with df.pivot_table(...)
 6. Do NOT set template, font colors, paper_bgcolor, or plot_bgcolor — the frontend handles theming
@@ -64,25 +86,69 @@ RULES:
 9. Return raw JSON only, no markdown code blocks"""
 
 
-def parse_visualize_response(raw: str) -> dict:
-    text = raw.strip()
+def _no_chart_needed(columns: list, rows: list) -> bool:
+    """True for results the prompt already tells the model not to chart.
+
+    Covers a single scalar value and a single column of distinct text
+    values, so those requests skip the LLM round trip.
+    """
+    if len(columns) != 1:
+        return False
+    if len(rows) == 1:
+        return True
+    col = columns[0]
+    values = [row.get(col) for row in rows]
+    if any(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return False
+    # Repeated labels could still be counted into a bar chart
+    return len(set(map(str, values))) == len(values)
+
+
+def build_visualize_prompt(question: str, sql: str, columns: list, rows: list) -> tuple[str, str]:
+    """Return the (system, user) messages for a visualize request.
+
+    The system message is always VISUALIZE_SYSTEM_PROMPT; the user message
+    carries the question, SQL and up to PROMPT_MAX_ROWS result rows.
+    """
+    # Missing keys render as NULL; the table stops early once it would
+    # exceed the character budget
+    lines = []
+    budget = PROMPT_ROWS_BUDGET
+    for i, row in enumerate(rows[:PROMPT_MAX_ROWS]):
+        line = " | ".join([prompt_value(row.get(c, "NULL")) for c in columns])
+        if len(line) > budget:
+            lines.append(f"… ({len(rows) - i} more rows omitted)")
+            break
+        budget -= len(line)
+        lines.append(line)
+    rows_text = "\n".join(lines)
+
+    user_message = f"""USER QUESTION: {question}
+SQL QUERY: {sql}
 
-    if text.startswith("```"):
-        lines = text.split("\n")
-        lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        text = "\n".join(lines).strip()
+QUERY RESULTS ({len(rows)} total rows, showing up to {PROMPT_MAX_ROWS}):
+Columns: {' | '.join(columns)}
+{rows_text}
+
+Generate Python visualization code for these query results."""
+    return VISUALIZE_SYSTEM_PROMPT, user_message
+
+
+def parse_visualize_response(raw: str) -> dict:
+    text = strip_code_fence(raw.strip())
+    # Only a JSON object is accepted; skip both parse attempts without a brace
+    if "{" not in text:
+        return {"pythonCode": None}
 
-    import re
     parsed = None
     try:
-        parsed = json.loads(text)
+        parsed = loads(text)
     except json.JSONDecodeError:
-        match = re.search(r"\{[^{}]*(?:\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}[^{}]*)*\}", text, re.DOTALL)
-        if match:
+        # Try to extract the first balanced {...} block
+        candidate = find_json_object(text)
+        if candidate is not None:
             try:
-                parsed = json.loads(match.group())
+                parsed = loads(candidate)
             except json.JSONDecodeError:
                 pass
 
@@ -100,27 +166,38 @@ def parse_visualize_response(raw: str) -> dict:
     return {"pythonCode": python_code, "chartTitle": chart_title}
 
 
-def execute_plot_code(python_code: str, df: pd.DataFrame) -> dict:
-    """Execute LLM-generated Python code in a restricted sandbox and return Plotly JSON."""
-    allowed_globals = {
-        "__builtins__": {},
-        "pd": pd,
-        "px": px,
-        "go": go,
-        "df": df,
-        "print": lambda *a, **k: None,
-    }
+def _parse_cached(raw: str) -> dict:
+    """parse_visualize_response with memoization on the raw content string.
+
+    Returns a fresh copy so callers can't mutate the cached result.
+    """
+    result = _parse_cache.get(raw)
+    if result is None:
+        result = parse_visualize_response(raw)
+        _parse_cache.put(raw, result)
+    return dict(result)
+
 
-    exec(python_code, allowed_globals)
+def _compile_plot_code(python_code: str):
+    """compile_plot_code, cached per source."""
+    fn = _code_cache.get(python_code)
+    if fn is None:
+        fn = compile_plot_code(python_code, "<plot>")
+        _code_cache.put(python_code, fn)
+    return fn
+
+
+def execute_plot_code(python_code: str, df: pd.DataFrame) -> dict:
+    """Execute LLM-generated Python code in a restricted sandbox and return the Plotly figure dict.
 
-    fig = allowed_globals.get("fig")
-    if fig is None:
-        raise ValueError("Code did not produce a `fig` variable")
+    The dict may hold numpy values; encode it with encode_response.
+    """
+    return run_plot(_compile_plot_code(python_code), df)
 
-    if not isinstance(fig, go.Figure):
-        raise ValueError(f"fig is not a plotly Figure (got {type(fig).__name__})")
 
-    return json.loads(fig.to_json())
+def _http_error_with_body(e: urllib.error.HTTPError, body: bytes) -> urllib.error.HTTPError:
+    """A copy of e whose body reads as body, independent of anyone else reading e."""
+    return urllib.error.HTTPError(e.url, e.code, e.reason, e.headers, io.BytesIO(body))
 
 
 def call_openrouter(system_prompt: str, user_message: str) -> str:
@@ -128,7 +205,7 @@ def call_openrouter(system_prompt: str, user_message: str) -> str:
     if not api_key:
         raise ValueError("OPENROUTER_API_KEY environment variable not set")
 
-    payload = json.dumps({
+    payload = dumps({
         "model": "openai/gpt-oss-120b:free",
         "messages": [
             {"role": "system", "content": system_prompt},
@@ -136,22 +213,77 @@ def call_openrouter(system_prompt: str, user_message: str) -> str:
         ],
         "temperature": 0.1,
         "max_tokens": 1024,
-    }).encode("utf-8")
-
-    req = urllib.request.Request(
-        "https://openrouter.ai/api/v1/chat/completions",
-        data=payload,
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        method="POST",
-    )
-
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        data = json.loads(resp.read().decode("utf-8"))
+    })
+
+    # Re-running or retrying a query sends an identical request; serve the
+    # stored completion instead of another multi-second round trip.
+    cache_key = hashlib.sha256(payload).digest()
+    cached = _completion_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # A burst of identical requests (e.g. repeated regenerate clicks) waits
+    # on the first one's call instead of each going upstream
+    with _inflight_lock:
+        cached = _completion_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        pending = _inflight.get(cache_key)
+        if pending is None:
+            future = _inflight[cache_key] = Future()
+    if pending is not None:
+        try:
+            return pending.result()
+        except urllib.error.HTTPError as e:
+            # The shared error's body is a stream; give each waiter its own
+            raise _http_error_with_body(e, e.fp.getvalue()) from None
 
-    return data["choices"][0]["message"]["content"]
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+    try:
+        data = loads(post_openrouter(payload, headers, 30))
+        choice = data["choices"][0]
+        content = choice["message"]["content"]
+        # A truncated reply is not worth replaying
+        if choice.get("finish_reason") != "length":
+            _completion_cache.put(cache_key, content)
+    except urllib.error.HTTPError as e:
+        # Read the body once, before anyone drains it
+        body = e.read()
+        future.set_exception(_http_error_with_body(e, body))
+        raise _http_error_with_body(e, body) from None
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(content)
+    finally:
+        with _inflight_lock:
+            del _inflight[cache_key]
+    return content
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows a gzip response.
+
+    A gzip entry takes precedence over "*", and q=0 marks a coding as not
+    acceptable.
+    """
+    qualities = {}
+    for entry in accept_encoding.lower().split(","):
+        coding, *params = entry.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
 
 
 class handler(BaseHTTPRequestHandler):
@@ -159,21 +291,21 @@ class handler(BaseHTTPRequestHandler):
         try:
             content_length = int(self.headers.get("Content-Length", 0))
             body = self.rfile.read(content_length)
-            data = json.loads(body.decode("utf-8"))
+            data = loads(body)
 
             question = data.get("question", "")
             sql = data.get("sql", "")
             columns = data.get("columns", [])
             rows = data.get("rows", [])
 
-            if not columns or not rows:
+            if not columns or not rows or _no_chart_needed(columns, rows):
                 self._send_json(200, {"plotlySpec": None})
                 return
 
-            system_prompt = build_visualize_prompt(question, sql, columns, rows)
-            raw = call_openrouter(system_prompt, "Generate Python visualization code for these query results.")
+            system_prompt, user_message = build_visualize_prompt(question, sql, columns, rows)
+            raw = call_openrouter(system_prompt, user_message)
             print(f"[visualize] raw LLM response ({len(raw)} chars): {raw[:500]}", file=sys.stderr)
-            result = parse_visualize_response(raw)
+            result = _parse_cached(raw)
             print(f"[visualize] parsed result: pythonCode={'present' if result.get('pythonCode') else 'null'}", file=sys.stderr)
 
             python_code = result.get("pythonCode")
@@ -204,9 +336,17 @@ class handler(BaseHTTPRequestHandler):
             self._send_error(500, f"Internal error: {str(e)}")
 
     def _send_json(self, status: int, data: dict):
-        body = json.dumps(data).encode("utf-8")
+        body = encode_response(data)
+        # Plotly specs repeat the same keys throughout, so even level 1
+        # shrinks them several times over
+        compress = len(body) >= GZIP_MIN_BYTES and _accepts_gzip(self.headers.get("Accept-Encoding", ""))
+        if compress:
+            body = gzip.compress(body, compresslevel=1)
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
         self.wfile.write(body)